@@ -2,14 +2,17 @@
 The exercises and classes are configured in json/yaml.
 Each directory inside courses/ holding an index.json/yaml is a course.
 '''
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import io
 import json
 from json.decoder import JSONDecodeError
 import os
 import re
+import threading
 import time
 import logging
-from typing import Any, Dict, Tuple
+from collections.abc import Mapping
 
 import yaml
 
@@ -17,14 +20,21 @@ from django.conf import settings
 from django.template import loader as django_template_loader
 from django.template.exceptions import TemplateDoesNotExist, TemplateSyntaxError
 
-from util.dict import get_rst_as_html
+from util.cache import FileCache, SingleFlight
+from util.dict import FrozenDict, FrozenList, freeze, get_rst_as_html, rst_cache
 from util.files import read_meta
+from util.fswatch import create_watcher
 from util.importer import import_named
 from util.static import symbolic_link
 
 
 META = "apps.meta"
 INDEX = "index"
+COURSES_TOKEN = ("courses",)
+# Changed when the format of the disk cache entries changes.
+DISK_CACHE_VERSION = 3
+# Seconds before a failed background reload is tried again.
+RELOAD_RETRY_DELAY = 60
 DEFAULT_LANG = "en"
 
 LOGGER = logging.getLogger('main')
@@ -106,6 +116,8 @@ class ConfigParser:
         'i18n': lambda root, parent, value, **kwargs: value.get(kwargs['lang']),
         'rst': lambda root, parent, value, **kwargs: get_rst_as_html(value),
     }
+    # The cache statistics are logged after this many exercise lookups.
+    STATS_LOG_INTERVAL = 1000
 
     def __init__(self):
         '''
@@ -113,6 +125,18 @@ class ConfigParser:
         '''
         self._courses = {}
         self._dir_mtime = 0
+        self._disk = None
+        self._fs_watcher = None
+        self._loads = SingleFlight()
+        self._stats_lock = threading.Lock()
+        self._lookups = 0
+        self._include_lock = threading.Lock()
+        self._include_cache = {}
+        self._include_dependents = {}
+        self._reload_lock = threading.Lock()
+        self._reload_executor = None
+        self._reload_pid = None
+        self._reloading = set()
 
 
     def courses(self):
@@ -124,17 +148,29 @@ class ConfigParser:
         '''
 
         # Find all courses if exercises directory is modified.
-        t = os.path.getmtime(settings.COURSES_PATH)
+        watcher = self._watcher()
+        if watcher is None:
+            t = os.path.getmtime(settings.COURSES_PATH)
+        elif not self._dir_mtime or watcher.is_dirty(COURSES_TOKEN):
+            watcher.clean(COURSES_TOKEN)
+            t = os.path.getmtime(settings.COURSES_PATH)
+            watcher.watch(COURSES_TOKEN, dirs=[settings.COURSES_PATH])
+        else:
+            t = self._dir_mtime
         if self._dir_mtime < t:
-            self._courses.clear()
             self._dir_mtime = t
-            LOGGER.debug('Recreating course list.')
-            for item in os.listdir(settings.COURSES_PATH):
-                try:
-                    self._course_root(item)
-                except ConfigError:
-                    LOGGER.exception("Failed to load course: %s", item)
-                    continue
+            LOGGER.debug('Updating course list.')
+            items = os.listdir(settings.COURSES_PATH)
+
+            # Drop removed courses. The other cached courses are only
+            # reloaded if their files have changed.
+            for course_key in set(self._courses.keys()) - set(items):
+                del self._courses[course_key]
+
+            workers = max(1, min(settings.CONFIG_LOAD_WORKERS, len(items)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for _ in executor.map(self._load_course, items):
+                    pass
 
         # Pick course data into list.
         course_list = []
@@ -143,6 +179,45 @@ class ConfigParser:
         return course_list
 
 
+    def _load_course(self, course_key):
+        '''
+        Loads a course for the course list. Configuration errors are logged
+        so that they do not prevent loading the other courses.
+
+        @type course_key: C{str}
+        @param course_key: a course key
+        '''
+        cached = self._courses.get(course_key)
+        start = time.perf_counter()
+        try:
+            course_root = self._course_root(course_key)
+        except ConfigError:
+            LOGGER.exception("Failed to load course: %s", course_key)
+            self._courses.pop(course_key, None)
+            return
+        if course_root is None:
+            self._courses.pop(course_key, None)
+        elif course_root is not cached:
+            LOGGER.info('Course "%s" loaded in %.3f s', course_key, time.perf_counter() - start)
+
+
+    def cache_stats(self):
+        '''
+        Gets statistics of the configuration cache.
+
+        @rtype: C{dict}
+        @return: cache metrics by name
+        '''
+        return {
+            "courses": len(self._courses),
+            "exercise_lookups": self._lookups,
+            "coalesced_loads": self._loads.coalesced,
+            "rst_hits": rst_cache.hits,
+            "rst_misses": rst_cache.misses,
+            "include_files": len(self._include_cache),
+        }
+
+
     def course_entry(self, course_key):
         '''
         Gets a course entry.
@@ -191,6 +266,15 @@ class ConfigParser:
         @rtype: C{tuple}
         @return: course configuration or None, exercise configuration or None
         '''
+        with self._stats_lock:
+            self._lookups += 1
+            log_stats = self._lookups % self.STATS_LOG_INTERVAL == 0
+        if log_stats:
+            LOGGER.info('Configuration cache: %s', ', '.join(
+                '%d %s' % (value, name.replace('_', ' '))
+                for name, value in self.cache_stats().items()
+            ))
+
         if isinstance(course, dict):
           course_root, course_key = course, course['data']['key']
         else:
@@ -211,12 +295,10 @@ class ConfigParser:
         # Try to find version for requested or configured language.
         for lang in (lang, course_root["lang"]):
             if lang in exercise_root["data"]:
-                exercise = exercise_root["data"][lang]
-                exercise["lang"] = lang
-                return course_root["data"], exercise
+                return course_root["data"], exercise_root["data"][lang]
 
-        # Fallback to any existing language version.
-        return course_root["data"], list(exercise_root["data"].values())[0]
+        # Fallback to the default language version.
+        return course_root["data"], exercise_root["data"].default
 
 
     def _course_root_from_root_dir(self, course_key, root_dir):
@@ -238,6 +320,38 @@ class ConfigParser:
             return None
 
         t = os.path.getmtime(f)
+        cache = self._disk_cache()
+        cache_key = ("course", DISK_CACHE_VERSION, course_key, f)
+        course_root = cache.get(cache_key) if cache else None
+        if course_root is not None and course_root["mtime"] == t:
+            LOGGER.debug('Loaded course "%s" from the disk cache', course_key)
+        else:
+            course_root = self._parse_course(course_key, root_dir, f, t, meta)
+            if cache:
+                cache.set(cache_key, course_root)
+
+        course_root["exercise_loader"] = self._exercise_loader(course_root["data"])
+        course_root["exercises"] = {}
+        return course_root
+
+
+    def _parse_course(self, course_key, root_dir, f, t, meta):
+        '''
+        Parses and processes the course index file.
+
+        @type course_key: C{str}
+        @param course_key: a course key
+        @type root_dir: C{str}
+        @param root_dir: directory where the course directory is
+        @type f: C{str}
+        @param f: path to the course index file
+        @type t: C{float}
+        @param t: modification time of the index file
+        @type meta: C{dict}
+        @param meta: course meta data
+        @rtype: C{dict}
+        @return: course root without the exercise loader and exercises
+        '''
         data = self._parse(f)
         if data is None:
             raise ConfigError('Failed to parse configuration file "%s"' % (f))
@@ -280,11 +394,6 @@ class ConfigParser:
             data["exercises"] = keys
             data["config_files"] = config
 
-        # Enable course configurable ecercise_loader function.
-        exercise_loader = self._default_exercise_loader
-        if "exercise_loader" in data:
-            exercise_loader = import_named(data, data["exercise_loader"])
-
         return {
             "meta": meta,
             "file": f,
@@ -292,11 +401,39 @@ class ConfigParser:
             "ptime": time.time(),
             "data": data,
             "lang": self._default_lang(data),
-            "exercise_loader": exercise_loader,
-            "exercises": {}
         }
 
 
+    def _exercise_loader(self, data):
+        '''
+        Gets the exercise loader function configured for a course.
+
+        @type data: C{dict}
+        @param data: course configuration
+        @rtype: C{function}
+        @return: the exercise loader
+        '''
+        # Enable course configurable ecercise_loader function.
+        if "exercise_loader" in data:
+            return import_named(data, data["exercise_loader"])
+        return self._default_exercise_loader
+
+
+    def _disk_cache(self):
+        '''
+        Gets the disk cache of processed configurations, if it is enabled.
+
+        @rtype: C{util.cache.FileCache}
+        @return: the disk cache or None
+        '''
+        path = getattr(settings, "CONFIG_CACHE_PATH", None)
+        if not path:
+            return None
+        if self._disk is None or self._disk.path != path:
+            self._disk = FileCache(path)
+        return self._disk
+
+
     def _course_root(self, course_key):
         '''
         Gets course dictionary root (meta and data).
@@ -307,24 +444,155 @@ class ConfigParser:
         @return: course root or None
         '''
 
+        token = ("course", course_key)
+        watcher = self._watcher()
+
         # Try cached version.
         if course_key in self._courses:
             course_root = self._courses[course_key]
-            try:
-                if course_root["mtime"] >= os.path.getmtime(course_root["file"]):
+            if watcher:
+                if not watcher.is_dirty(token):
                     return course_root
-            except OSError:
-                pass
+            elif self._recently_validated(course_root):
+                return course_root
+            else:
+                try:
+                    if course_root["mtime"] >= os.path.getmtime(course_root["file"]):
+                        course_root["vtime"] = time.time()
+                        return course_root
+                except OSError:
+                    pass
+            if self._reload_in_background(token, course_root, self._load_course_root, course_key):
+                return course_root
 
+        # Concurrent callers share a single load.
+        return self._loads.do(token, self._load_course_root, course_key)
+
+
+    def _load_course_root(self, course_key):
+        '''
+        Loads a course root and stores it in the cache.
+
+        @type course_key: C{str}
+        @param course_key: a course key
+        @rtype: C{dict}
+        @return: course root or None
+        '''
+        token = ("course", course_key)
+        watcher = self._watcher()
+        if watcher:
+            watcher.clean(token)
+        # Files modified after this are reloaded again.
+        since = time.time_ns()
         course_root = self._course_root_from_root_dir(course_key, settings.COURSES_PATH)
         if course_root is None:
+            self._courses.pop(course_key, None)
             return None
 
+        if course_key in self._courses:
+            self._inherit_exercises(self._courses[course_key], course_root)
         self._courses[course_key] = course_root
+        if watcher:
+            course_dir = os.path.join(settings.COURSES_PATH, course_key)
+            watcher.watch(token, files=[
+                course_root["file"],
+                course_dir,
+                os.path.join(course_dir, META),
+            ], since=since)
         symbolic_link(settings.COURSES_PATH, course_root["data"])
         return course_root
 
 
+    def _reload_in_background(self, token, stale_root, load, *args):
+        '''
+        Schedules a stale root to be reloaded in a background thread,
+        if background reloading is enabled.
+
+        @type token: C{tuple}
+        @param token: identifies the course or exercise
+        @type stale_root: C{dict}
+        @param stale_root: the cached root that is served until the reload completes
+        @type load: C{function}
+        @param load: the function that loads and stores the new root
+        @rtype: C{bool}
+        @return: True if the stale root should be served
+        '''
+        if not getattr(settings, "CONFIG_BACKGROUND_RELOAD", False):
+            return False
+        if stale_root.get("retry_time", 0) > time.time():
+            return True
+
+        with self._reload_lock:
+            if self._reload_pid != os.getpid():
+                # Threads do not survive a fork.
+                self._reload_executor = ThreadPoolExecutor(
+                    max_workers=2,
+                    thread_name_prefix="config-reload",
+                )
+                self._reload_pid = os.getpid()
+                self._reloading.clear()
+            if token not in self._reloading:
+                self._reloading.add(token)
+                self._reload_executor.submit(self._reload, token, stale_root, load, *args)
+        return True
+
+
+    def _reload(self, token, stale_root, load, *args):
+        '''
+        Reloads a root in a background thread. The new root replaces the stale
+        one only if it loads successfully.
+        '''
+        try:
+            self._loads.do(token, load, *args)
+        except Exception:
+            # Keep serving the last good version and try again later.
+            stale_root["retry_time"] = time.time() + RELOAD_RETRY_DELAY
+            LOGGER.exception("Failed to reload %s, serving the previous configuration.", token)
+        finally:
+            with self._reload_lock:
+                self._reloading.discard(token)
+
+
+    def _inherit_exercises(self, old_root, course_root):
+        '''
+        Moves the cached exercises of a replaced course root to the new root,
+        unless the course changes affect how they are loaded. The exercises
+        are validated against their own files when they are used.
+
+        @type old_root: C{dict}
+        @param old_root: the replaced course root
+        @type course_root: C{dict}
+        @param course_root: the new course root
+        '''
+        listed = course_root["data"].get("exercises", [])
+        # Other threads may still load exercises into the old root.
+        for exercise_key, exercise_root in list(old_root["exercises"].items()):
+            if (exercise_key in listed
+                    and exercise_root["course_deps"] == self._course_dependencies(course_root, exercise_key)):
+                course_root["exercises"][exercise_key] = exercise_root
+
+
+    def _course_dependencies(self, course_root, exercise_key):
+        '''
+        Gets the course settings that affect loading and processing an exercise.
+
+        @type course_root: C{dict}
+        @param course_root: a course root dictionary
+        @type exercise_key: C{str}
+        @param exercise_key: an exercise key
+        @rtype: C{tuple}
+        @return: values that must not change for a cached exercise to stay valid
+        '''
+        data = course_root["data"]
+        return (
+            course_root["lang"],
+            data["dir"],
+            course_root["meta"].get("grader_config"),
+            data.get("exercise_loader"),
+            data.get("config_files", {}).get(exercise_key, exercise_key),
+        )
+
+
     def _default_lang(self, data: dict) -> str:
         languages = data.get('language', data.get('lang'))
         data['lang'] = languages
@@ -349,21 +617,75 @@ class ConfigParser:
         @return: exercise root or None
         '''
 
-        include_file_timestamp = 0
+        token = self._exercise_token(course_root, exercise_key)
+        watcher = self._watcher()
+
         # Try cached version.
         if exercise_key in course_root["exercises"]:
             exercise_root = course_root["exercises"][exercise_key]
-            course_dir = self._conf_dir(course_root["data"]["dir"], meta=course_root["meta"])
-            include_ok, include_file_timestamp = self._check_include_file_timestamps(
-                exercise_root,
-                course_dir,
-            )
-            try:
-                if (exercise_root["mtime"] >= os.path.getmtime(exercise_root["file"])
-                        and include_ok):
+            if watcher:
+                if not watcher.is_dirty(token):
                     return exercise_root
-            except OSError:
-                pass
+            elif (self._recently_validated(exercise_root)
+                    or self._exercise_root_is_fresh(course_root, exercise_root)):
+                return exercise_root
+            if self._reload_in_background(token, exercise_root,
+                    self._load_exercise_root, course_root, exercise_key):
+                return exercise_root
+
+        # Concurrent callers share a single load.
+        return self._loads.do(token, self._load_exercise_root, course_root, exercise_key)
+
+
+    def _exercise_token(self, course_root, exercise_key):
+        '''
+        Identifies an exercise of a course root in the coalesced loads and in
+        the file watcher. The course file tells apart the published course
+        and the one being configured in the course store.
+        '''
+        return ("exercise", course_root["file"], course_root["data"]["key"], exercise_key)
+
+
+    def _load_exercise_root(self, course_root, exercise_key):
+        '''
+        Loads an exercise root from the disk cache or the configuration files
+        and stores it in the course root.
+
+        @type course_root: C{dict}
+        @param course_root: a course root dictionary
+        @type exercise_key: C{str}
+        @param exercise_key: an exercise key
+        @rtype: C{dict}
+        @return: exercise root or None
+        '''
+        token = self._exercise_token(course_root, exercise_key)
+        watcher = self._watcher()
+        if watcher:
+            watcher.clean(token)
+        # Files modified after this are reloaded again.
+        since = time.time_ns()
+        old_root = course_root["exercises"].get(exercise_key)
+        old_include_files = old_root.get("includes", []) if old_root else []
+        course_dir = self._conf_dir(course_root["data"]["dir"], meta=course_root["meta"])
+
+        # Try the disk cache shared by the worker processes.
+        cache = self._disk_cache()
+        cache_key = ("exercise", DISK_CACHE_VERSION, course_root["data"]["key"], course_root["file"], exercise_key)
+        if cache:
+            exercise_root = cache.get(cache_key)
+            if (exercise_root is not None
+                    and exercise_root["course_deps"] == self._course_dependencies(course_root, exercise_key)
+                    and self._exercise_root_is_fresh(course_root, exercise_root)):
+                LOGGER.debug('Loaded exercise "%s/%s" from the disk cache',
+                    course_root["data"]["key"], exercise_key)
+                if settings.CONFIG_IMMUTABLE:
+                    exercise_root["data"].freeze()
+                course_root["exercises"][exercise_key] = exercise_root
+                self._set_include_dependents(course_root["data"]["key"], exercise_key,
+                    old_include_files, exercise_root["includes"])
+                if watcher:
+                    watcher.watch(token, files=[exercise_root["file"]] + exercise_root["includes"], since=since)
+                return exercise_root
 
         LOGGER.debug('Loading exercise "%s/%s"', course_root["data"]["key"], exercise_key)
         file_name = exercise_key
@@ -382,28 +704,141 @@ class ConfigParser:
                 self._conf_dir(course_root["data"]["dir"], meta=course_root["meta"])
             )
         if not data:
+            course_root["exercises"].pop(exercise_key, None)
             return None
 
-        # Save the latest modification time of the exercise in the cache.
-        # If there is an included base template, its modification time may be later.
-        t = max(t, include_file_timestamp)
-
         # Process key modifiers and create language versions of the data.
         data = self._process_exercise_data(course_root, data)
-        for version in data.values():
-            self._check_fields(f, version, ["title", "view_type"])
-            version["key"] = exercise_key
-            version["mtime"] = t
 
-        course_root["exercises"][exercise_key] = exercise_root = {
+        # Save the latest modification time of the exercise in the cache.
+        # If there is an included base template, its modification time may be later.
+        # The times of the files are kept too, because a file may be replaced
+        # by an older one.
+        include_files = self._include_files(data, course_dir)
+        file_mtimes = {}
+        for config_file in [f] + include_files:
+            try:
+                file_mtimes[config_file] = os.path.getmtime(config_file)
+            except OSError:
+                continue
+            t = max(t, file_mtimes[config_file])
+
+        # The language versions have the same fields, only their values differ.
+        self._check_fields(f, data.default, ["title", "view_type"])
+        # The other languages are checked when they are processed.
+        self._check_comparisons(data.default)
+        data.set_fields(key=exercise_key, mtime=t)
+        if settings.CONFIG_IMMUTABLE:
+            data.freeze()
+
+        exercise_root = {
             "file": f,
             "mtime": t,
+            "file_mtimes": file_mtimes,
+            "includes": include_files,
             "ptime": time.time(),
+            "course_deps": self._course_dependencies(course_root, exercise_key),
             "data": data
         }
+        # Pickled before it is published, because the language versions
+        # processed later change it.
+        if cache:
+            cache.set(cache_key, exercise_root)
+        course_root["exercises"][exercise_key] = exercise_root
+        self._set_include_dependents(course_root["data"]["key"], exercise_key,
+            old_include_files, include_files)
+        if watcher:
+            watcher.watch(token, files=[f] + include_files, since=since)
         return exercise_root
 
 
+    def _exercise_root_is_fresh(self, course_root, exercise_root):
+        '''
+        Checks a cached exercise root against its configuration and include files.
+
+        @type course_root: C{dict}
+        @param course_root: a course root dictionary
+        @type exercise_root: C{dict}
+        @param exercise_root: a cached exercise root
+        @rtype: C{bool}
+        @return: True if the root is up-to-date
+        '''
+        for config_file, mtime in exercise_root["file_mtimes"].items():
+            try:
+                if os.path.getmtime(config_file) == mtime:
+                    continue
+            except OSError:
+                pass
+            # The other exercises that include the changed files are stale too.
+            self._invalidate_changed_includes(exercise_root.get("includes", []))
+            return False
+        exercise_root["vtime"] = time.time()
+        return True
+
+
+    def _recently_validated(self, root):
+        '''
+        Checks whether a cached root was validated within the revalidation interval,
+        in which case it is trusted without checking the files.
+
+        @type root: C{dict}
+        @param root: a course or exercise root
+        @rtype: C{bool}
+        @return: True if the root can be used without checking the files
+        '''
+        interval = getattr(settings, "CONFIG_REVALIDATE_INTERVAL", 0)
+        return interval > 0 and time.time() - root.get("vtime", root["ptime"]) < interval
+
+
+    @staticmethod
+    def _check_comparisons(exercise):
+        '''
+        Checks the answer comparisons of a questionnaire version, so that
+        invalid values raise ConfigError when the version is processed.
+
+        @type exercise: C{dict}
+        @param exercise: an exercise configuration version
+        '''
+        if "fieldgroups" in exercise:
+            # The form types depend on this module.
+            from access.types.compare import check_comparisons
+            check_comparisons(exercise)
+
+
+    def _include_files(self, data, course_dir):
+        '''
+        Lists the configuration files included into an exercise.
+
+        @type data: C{LanguageVersions}
+        @param data: language versions of the exercise configuration
+        @type course_dir: C{str}
+        @param course_dir: a path to the course root directory
+        @rtype: C{list}
+        @return: paths to the included files
+        '''
+        files = []
+        for include_data in data.default.get("include", []):
+            include_file = self._get_config(os.path.join(course_dir, include_data["file"]))
+            if include_file not in files:
+                files.append(include_file)
+        return files
+
+
+    def _watcher(self):
+        '''
+        Gets the file watcher that invalidates cached roots, if it is enabled.
+
+        @rtype: C{util.fswatch.FileWatcher}
+        @return: the file watcher or None
+        '''
+        mode = getattr(settings, "CONFIG_WATCH", None)
+        if not mode:
+            return None
+        if self._fs_watcher is None:
+            self._fs_watcher = create_watcher(mode, settings.CONFIG_WATCH_POLL_INTERVAL)
+        return self._fs_watcher
+
+
     def _check_fields(self, file_name, data, field_names):
         '''
         Verifies that a given dict contains a set of keys.
@@ -494,32 +929,6 @@ class ConfigParser:
         return data
 
 
-    def _check_include_file_timestamps(self, exercise_root: Dict[str, Any], course_dir: str) -> Tuple[bool, int]:
-        """Check the exercise modification time against the modification timestamps
-        of the included configuration templates.
-
-        Included configuration templates are set in the data["include] field
-        (if they are used).
-
-        @param exercise_root: root dict of the exercise configuration
-        @param course_dir: file path to the course
-        @return: 2-tuple (boolean, int) True if the exercise is up-to-date
-            (not older than the latest modification in included files), and
-            the latest included file modification timestamp
-        """
-        max_include_timestamp = 0
-        for data in exercise_root["data"].values():
-            for include_data in data.get("include", []):
-                include_file = self._get_config(os.path.join(course_dir, include_data["file"]))
-                try:
-                    include_timestamp = os.path.getmtime(include_file)
-                    if include_timestamp > max_include_timestamp:
-                        max_include_timestamp = include_timestamp
-                except OSError:
-                    return False, 0
-        return exercise_root["mtime"] >= max_include_timestamp, max_include_timestamp
-
-
     def _include(self, data, target_file, course_dir):
         '''
         Includes the config files defined in data["include"] into data.
@@ -545,22 +954,7 @@ class ConfigParser:
                 self._check_fields(target_file, include_data, ("file",))
 
                 include_file = self._get_config(os.path.join(course_dir, include_data["file"]))
-                loader = self.FORMATS[os.path.splitext(include_file)[1][1:]]
-
-                if "template_context" in include_data:
-                    # Load new data from rendered include file string
-                    render_context = include_data["template_context"]
-                    template_name = os.path.join(course_dir, include_file)
-                    template_name = template_name[len(settings.COURSES_PATH)+1:] # FIXME: XXX: NOTE: TODO: Fix this hack
-                    rendered = django_template_loader.render_to_string(
-                                template_name,
-                                render_context
-                            )
-                    new_data = loader(io.StringIO(rendered))
-                else:
-                    # Load new data directly from the include file
-                    with open(include_file, 'r') as f:
-                        new_data = loader(f)
+                new_data = self._read_include(include_file, include_data, course_dir)
             except (OSError, KeyError, ValueError, yaml.YAMLError, TemplateDoesNotExist, TemplateSyntaxError) as e:
                 raise ConfigError(
                     f'Error in parsing the config file to be included into "{target_file}".', error=e,
@@ -589,6 +983,131 @@ class ConfigParser:
         return return_data
 
 
+    def _read_include(self, include_file, include_data, course_dir):
+        '''
+        Gets the data of an include file. The parsed data is cached by the file
+        modification time and the template context, because the same base file
+        is typically included into many exercises. The cached data is shared
+        and must not be modified.
+
+        @type include_file: C{str}
+        @param include_file: a path to the include file
+        @type include_data: C{dict}
+        @param include_data: the include entry of the including file
+        @type course_dir: C{str}
+        @param course_dir: a path to the course root directory
+        @rtype: C{dict}
+        @return: the included data
+        '''
+        mtime = os.path.getmtime(include_file)
+        context_key = None
+        if "template_context" in include_data:
+            context_key = hashlib.sha1(json.dumps(include_data["template_context"],
+                sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+        with self._include_lock:
+            entry = self._include_cache.get(include_file)
+            if entry is not None and entry[0] != mtime:
+                self._invalidate_include(include_file)
+                entry = None
+            if entry is not None and context_key in entry[1]:
+                return entry[1][context_key]
+
+        new_data = self._parse_include(include_file, include_data, course_dir)
+        with self._include_lock:
+            entry = self._include_cache.setdefault(include_file, (mtime, {}))
+            if entry[0] == mtime:
+                entry[1][context_key] = new_data
+        return new_data
+
+
+    def _parse_include(self, include_file, include_data, course_dir):
+        '''
+        Parses an include file, rendering it as a template first if the
+        include entry has a template context.
+
+        @type include_file: C{str}
+        @param include_file: a path to the include file
+        @type include_data: C{dict}
+        @param include_data: the include entry of the including file
+        @type course_dir: C{str}
+        @param course_dir: a path to the course root directory
+        @rtype: C{dict}
+        @return: the included data
+        '''
+        loader = self.FORMATS[os.path.splitext(include_file)[1][1:]]
+
+        if "template_context" in include_data:
+            # Load new data from rendered include file string
+            render_context = include_data["template_context"]
+            template_name = os.path.join(course_dir, include_file)
+            template_name = template_name[len(settings.COURSES_PATH)+1:] # FIXME: XXX: NOTE: TODO: Fix this hack
+            rendered = django_template_loader.render_to_string(
+                        template_name,
+                        render_context
+                    )
+            return loader(io.StringIO(rendered))
+
+        # Load new data directly from the include file
+        with open(include_file, 'r') as f:
+            return loader(f)
+
+
+    def _invalidate_include(self, include_file):
+        '''
+        Drops the cached data of a changed include file and makes the exercises
+        that include it check their files when they are next used.
+        The caller holds the include lock.
+
+        @type include_file: C{str}
+        @param include_file: a path to the include file
+        '''
+        self._include_cache.pop(include_file, None)
+        for course_key, exercise_key in self._include_dependents.get(include_file, ()):
+            course_root = self._courses.get(course_key)
+            if course_root is not None:
+                exercise_root = course_root["exercises"].get(exercise_key)
+                if exercise_root is not None:
+                    exercise_root["vtime"] = 0
+
+
+    def _invalidate_changed_includes(self, include_files):
+        '''
+        Invalidates the include files that have changed since they were cached.
+
+        @type include_files: C{list}
+        @param include_files: paths to the include files
+        '''
+        with self._include_lock:
+            for include_file in include_files:
+                entry = self._include_cache.get(include_file)
+                if entry is None:
+                    continue
+                try:
+                    changed = os.path.getmtime(include_file) != entry[0]
+                except OSError:
+                    changed = True
+                if changed:
+                    self._invalidate_include(include_file)
+
+
+    def _set_include_dependents(self, course_key, exercise_key, old_include_files, include_files):
+        '''
+        Updates the index from the include files to the exercises that include them.
+        '''
+        dependent = (course_key, exercise_key)
+        with self._include_lock:
+            for include_file in set(old_include_files) - set(include_files):
+                dependents = self._include_dependents.get(include_file)
+                if dependents is not None:
+                    dependents.discard(dependent)
+                    if not dependents:
+                        del self._include_dependents[include_file]
+                        self._include_cache.pop(include_file, None)
+            for include_file in include_files:
+                self._include_dependents.setdefault(include_file, set()).add(dependent)
+
+
     def _default_exercise_loader(self, course_root, exercise_key, course_dir):
         '''
         Default loader to find and parse file.
@@ -613,46 +1132,196 @@ class ConfigParser:
         '''
         Processes a data dictionary according to embedded processor flags
         and creates a data dict version for each language intercepted.
+        Only the default language version is processed immediately, the
+        other versions are processed when they are first accessed.
+        The parts that do not depend on the language are shared between
+        the versions and frozen, so that they are not modified by accident.
 
         @type course_root: C{dict}
         @param course_root: a course root dictionary
         @type data: C{dict}
-        @param data: a config data dictionary to process (in-place)
+        @param data: a config data dictionary to process
+        @rtype: C{LanguageVersions}
+        @return: the language versions by language code
         '''
         default_lang = course_root['lang']
         lang_keys = []
+        default = self._process_language(data, default_lang, lang_keys)
+        languages = [default_lang] + sorted(set(lang_keys) - set([default_lang]))
+        return LanguageVersions(data, languages, { default_lang: default }, self._process_checked_language)
+
+
+    @classmethod
+    def _process_checked_language(cls, data, lang, shared=None):
+        '''
+        Creates the version of a data dictionary for a language that is not
+        the default one and checks its answer comparisons.
+        '''
+        version = cls._process_language(data, lang, shared=shared)
+        cls._check_comparisons(version)
+        return version
+
+
+    @classmethod
+    def _process_language(cls, data, lang, lang_keys=None, shared=None):
+        '''
+        Creates the version of a data dictionary for a language.
+
+        The version of the default language is created first and the
+        intercepted language codes are collected. If there are other languages,
+        the subtrees without i18n tags are frozen in the default version and
+        the other versions are given the same subtrees instead of copies.
+
+        @type data: C{dict}
+        @param data: a config data dictionary to process
+        @type lang: C{str}
+        @param lang: the language code
+        @type lang_keys: C{list}
+        @param lang_keys: a list to collect the intercepted language codes into
+        @type shared: C{dict}
+        @param shared: the default language version to share the frozen subtrees of
+        @rtype: C{dict}
+        @return: the processed data
+        '''
         tags_processed = []
+        # The (container, key) pairs of the largest language independent subtrees.
+        independent = []
 
-        def recursion(n, lang, collect_lang=False):
+        def recursion(n, s):
+            # Returns the processed node and whether it is language independent.
+            if isinstance(s, (FrozenDict, FrozenList)):
+                return s, True
             t = type(n)
             if t == dict:
                 d = {}
+                d_independent = {}
                 for k in sorted(n.keys(), key=lambda x: (len(x), x)):
                     v = n[k]
-                    m = self.PROCESSOR_TAG_REGEX.match(k)
+                    i18n = False
+                    m = cls.PROCESSOR_TAG_REGEX.match(k)
                     while m:
                         k, tag = m.groups()
                         tags_processed.append(tag)
-                        if collect_lang and tag == 'i18n' and type(v) == dict:
-                            lang_keys.extend(v.keys())
-                        if tag not in self.TAG_PROCESSOR_DICT:
+                        if tag == 'i18n':
+                            i18n = True
+                            if lang_keys is not None and type(v) == dict:
+                                lang_keys.extend(v.keys())
+                        if tag not in cls.TAG_PROCESSOR_DICT:
                             raise ConfigError('Unsupported processor tag "%s"' % (tag))
-                        v = self.TAG_PROCESSOR_DICT[tag](d, n, v, lang=lang)
-                        m = self.PROCESSOR_TAG_REGEX.match(k)
-                    d[k] = recursion(v, lang, collect_lang)
-                return d
+                        v = cls.TAG_PROCESSOR_DICT[tag](d, n, v, lang=lang)
+                        m = cls.PROCESSOR_TAG_REGEX.match(k)
+                    d[k], is_independent = recursion(v,
+                        s.get(k) if type(s) == dict and not i18n else None)
+                    d_independent[k] = is_independent and not i18n
+                if not all(d_independent.values()):
+                    independent.extend((d, k) for k, i in d_independent.items() if i)
+                return d, all(d_independent.values())
             elif t == list:
-                return [recursion(v, lang, collect_lang) for v in n]
+                l = []
+                l_independent = []
+                for i, v in enumerate(n):
+                    v, is_independent = recursion(v,
+                        s[i] if type(s) == list and i < len(s) else None)
+                    l.append(v)
+                    l_independent.append(is_independent)
+                if not all(l_independent):
+                    independent.extend((l, i) for i, is_independent in enumerate(l_independent) if is_independent)
+                return l, all(l_independent)
             else:
-                return n
+                return n, True
+
+        version, _ = recursion(data, shared)
+        if lang_keys is not None and set(lang_keys) - set([lang]):
+            for container, key in independent:
+                container[key] = freeze(container[key])
+        LOGGER.debug('Processed %d tags for language "%s".', len(tags_processed), lang)
+        return version
+
+
+class LanguageVersions(Mapping):
+    '''
+    Language versions of an exercise configuration by language code.
+    Versions are processed from the source data when they are first accessed,
+    and the fields set with set_fields() are added to them. Each version has
+    its language code in the "lang" field.
+    '''
 
-        default = recursion(data, default_lang, True)
-        root = { default_lang: default }
-        for lang in (set(lang_keys) - set([default_lang])):
-            root[lang] = recursion(data, lang)
+    def __init__(self, source, languages, versions, process):
+        self._source = source
+        self._languages = languages
+        self._versions = versions
+        # The default version as processed. Its language independent subtrees
+        # are frozen and shared by the versions processed later. It is kept
+        # unfrozen by freeze(), so that the other parts are processed again.
+        self._shared = versions[languages[0]]
+        self._process = process
+        self._fields = {}
+        self._frozen = False
+        self._lock = threading.Lock()
+        for lang, version in versions.items():
+            version["lang"] = lang
+
+    def __getitem__(self, lang):
+        version = self._versions.get(lang)
+        if version is not None:
+            return version
+        if lang not in self._languages:
+            raise KeyError(lang)
+        with self._lock:
+            if lang not in self._versions:
+                version = self._process(self._source, lang, shared=self._shared)
+                version.update(self._fields)
+                version["lang"] = lang
+                if self._frozen:
+                    version = freeze(version)
+                self._versions[lang] = version
+        return self._versions[lang]
+
+    def __contains__(self, lang):
+        return lang in self._languages
+
+    def __iter__(self):
+        return iter(self._languages)
+
+    def __len__(self):
+        return len(self._languages)
+
+    def __repr__(self):
+        return 'LanguageVersions(%r)' % (self._languages)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def default(self):
+        '''
+        The version of the default language.
+        '''
+        return self[self._languages[0]]
 
-        LOGGER.debug('Processed %d tags.', len(tags_processed))
-        return root
+    def set_fields(self, **fields):
+        '''
+        Sets fields in every language version, including the ones processed later.
+        '''
+        with self._lock:
+            self._fields.update(fields)
+            for version in self._versions.values():
+                version.update(fields)
+
+    def freeze(self):
+        '''
+        Makes every language version immutable, including the ones processed later.
+        '''
+        with self._lock:
+            self._frozen = True
+            for lang, version in self._versions.items():
+                self._versions[lang] = freeze(version)
 
 
 # An object that holds on to the latest exercise configuration.
@@ -0,0 +1,166 @@
+import copy
+import gc
+import random
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from access.config import ConfigParser
+from access.types.forms import GradedForm, get_subdiff_hints
+
+
+def synthetic_exercise(n, languages):
+    ''' Creates a questionnaire configuration with a few translated strings '''
+    return {
+        'key': 'exercise_%d' % (n),
+        'title|i18n': { lang: 'Exercise %d (%s)' % (n, lang) for lang in languages },
+        'view_type': 'access.types.stdsync.createForm',
+        'max_points': 10,
+        'fieldgroups': [
+            {
+                'title|i18n': { lang: 'Group %d (%s)' % (g, lang) for lang in languages },
+                'fields': [
+                    {
+                        'key': 'field_%d_%d' % (g, f),
+                        'type': 'radio',
+                        'points': 1,
+                        'title': 'Question %d' % (f),
+                        'more': 'Choose the correct option out of the listed ones.',
+                        'options': [
+                            {
+                                'value': 'option_%d' % (o),
+                                'label': 'Option %d' % (o),
+                                'correct': o == 0,
+                            }
+                            for o in range(4)
+                        ],
+                        'feedback': [
+                            { 'value': 'option_%d' % (o), 'label': 'Not quite.' }
+                            for o in range(1, 4)
+                        ],
+                    }
+                    for f in range(5)
+                ],
+            }
+            for g in range(2)
+        ],
+    }
+
+
+def synthetic_form(field_count):
+    '''Creates a questionnaire configuration with text fields and radio buttons'''
+    return {
+        'key': 'form',
+        'lang': 'en',
+        'mtime': 1,
+        'title': 'Form',
+        'fieldgroups': [{
+            'fields': [
+                {
+                    'key': 'field_%d' % (f),
+                    'type': ('text', 'textarea', 'radio')[f % 3],
+                    'title': 'Question %d' % (f),
+                    'points': 1,
+                    'correct': 'answer',
+                    'extra_info': { 'placeholder': 'Write your answer %d here' % (f) },
+                    'options': [
+                        { 'value': 'option_%d' % (o), 'label': 'Option %d' % (o), 'correct': o == 0 }
+                        for o in range(4)
+                    ],
+                }
+                for f in range(field_count)
+            ],
+        }],
+    }
+
+
+def measure(func):
+    ''' Returns the result, the seconds and the bytes allocated by func '''
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, size
+
+
+class Command(BaseCommand):
+    help = "Runs performance benchmarks on synthetic data."
+    BENCHMARKS = ("config_memory", "form_fields", "subdiff")
+
+    def add_arguments(self, parser):
+        parser.add_argument("benchmarks", nargs="*",
+            help="benchmarks to run: %s (default all)" % (", ".join(self.BENCHMARKS)))
+        parser.add_argument("--exercises", type=int, default=500,
+            help="number of synthetic exercises")
+
+    def handle(self, *args, **options):
+        names = options["benchmarks"] or list(self.BENCHMARKS)
+        for name in names:
+            if name not in self.BENCHMARKS:
+                self.stderr.write("Unknown benchmark: %s" % (name))
+                continue
+            self.stdout.write("\n  %s:" % (name))
+            getattr(self, name)(options)
+
+    def config_memory(self, options):
+        languages = ['en', 'fi', 'sv']
+        sources = [synthetic_exercise(n, languages) for n in range(options["exercises"])]
+        parser = ConfigParser()
+
+        def process():
+            exercises = [parser._process_exercise_data({'lang': languages[0]}, data) for data in sources]
+            for versions in exercises:
+                for lang in versions:
+                    versions[lang]
+            return exercises
+
+        def unshared():
+            # Deep copies do not share anything, like the versions did before.
+            return [
+                { lang: copy.deepcopy(versions[lang]) for lang in versions }
+                for versions in shared
+            ]
+
+        shared, seconds, shared_size = measure(process)
+        self.stdout.write("%d exercises in %d languages processed in %.3f s" % (
+            len(sources), len(languages), seconds))
+        _, _, unshared_size = measure(unshared)
+        self.stdout.write("shared language versions:   %8.1f KiB" % (shared_size / 1024))
+        self.stdout.write("unshared language versions: %8.1f KiB" % (unshared_size / 1024))
+        self.stdout.write("saved: %.0f %%" % (100 * (1 - shared_size / unshared_size)))
+
+    def form_fields(self, options):
+        course = { 'key': 'benchmark' }
+        rounds = 20
+        for field_count in (10, 40, 160):
+            exercise = synthetic_form(field_count)
+            # Without the modification time the exercise has no form blueprint.
+            unidentified = dict(exercise)
+            del unidentified['mtime']
+            for name, config in (("built", unidentified), ("blueprint", exercise)):
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    GradedForm(None, exercise=config, course=course)
+                seconds = (time.perf_counter() - start) / rounds
+                self.stdout.write("%4d fields, %-9s: %7.2f ms per form, %.3f ms per field" % (
+                    field_count, name, seconds * 1000, seconds * 1000 / field_count))
+
+    def subdiff(self, options):
+        rng = random.Random(0)
+        solution = "for (int i = 0; i < n; i++) { sum += values[i]; }"
+        alphabet = "abcdefghijklmnopqrstuvwxyz0123456789 ;(){}[]=+<"
+        for length in (10, 100, 1000, 10000, 100000):
+            # Answers that resemble the solution but have typos in it.
+            answer = "".join(
+                rng.choice(alphabet) if rng.random() < 0.1 else solution[n % len(solution)]
+                for n in range(length)
+            )
+            rounds = max(1, 1000 // length)
+            start = time.perf_counter()
+            for _ in range(rounds):
+                get_subdiff_hints(answer, solution + "|" + solution.replace(" ", ""))
+            seconds = (time.perf_counter() - start) / rounds
+            self.stdout.write("%6d chars: %9.3f ms" % (length, seconds * 1000))
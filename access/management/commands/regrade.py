@@ -0,0 +1,195 @@
+import json
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand, CommandError
+
+from access.config import ConfigError
+from access.views import config
+from util.files import stored_submissions
+from util.http import update_url_params
+
+
+class ResultCollector:
+    '''
+    Receives the grading results that the grader posts for the regraded
+    submissions. Each submission has its own result URL that ends with the
+    submission id.
+    '''
+
+    def __init__(self, address):
+        host, _, port = address.rpartition(":")
+        collector = self
+        self._results = {}
+        self._received = threading.Condition()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                sid = urllib.parse.unquote(self.path.strip("/"))
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8")
+                values = urllib.parse.parse_qs(body, keep_blank_values=True)
+                collector.receive(sid, { k: v[0] for k, v in values.items() })
+                response = json.dumps({ "success": True }).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((host or "localhost", int(port)), Handler)
+        except (OSError, ValueError) as e:
+            raise CommandError("Can not collect the results at %s: %s" % (address, e))
+        self._thread = threading.Thread(target=self._server.serve_forever,
+            name="ResultCollector", daemon=True)
+        self._thread.start()
+
+    def url(self, sid):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d/%s" % (host, port, urllib.parse.quote(sid))
+
+    def receive(self, sid, values):
+        record = { "sid": sid }
+        for key in ("points", "max_points"):
+            try:
+                record[key] = int(values.get(key, 0))
+            except ValueError:
+                record[key] = 0
+        for key in ("error", "grading_data", "feedback"):
+            if key in values:
+                record[key] = values[key]
+        with self._received:
+            self._results[sid] = record
+            self._received.notify_all()
+
+    def wait(self, sids, timeout):
+        '''
+        Yields the results of the submissions as they are received, and
+        an error for the ones that are not received within the time limit.
+        '''
+        waiting = set(sids)
+        deadline = time.monotonic() + timeout
+        while waiting:
+            with self._received:
+                received = waiting.intersection(self._results)
+                if not received:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._received.wait(remaining)
+                    continue
+                records = [self._results.pop(sid) for sid in sorted(received)]
+            waiting -= received
+            yield from records
+        for sid in sorted(waiting):
+            yield { "sid": sid, "error": "No result received in %s seconds" % (timeout) }
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class Command(BaseCommand):
+    help = "Regrades the stored submissions of an exercise that is graded in a container."
+
+    def add_arguments(self, parser):
+        parser.add_argument("exercise", help="Exercise as <course_key>/<exercise_key>")
+        parser.add_argument("--output", required=True,
+            help="JSONL file for the results, one line per submission")
+        parser.add_argument("--lang", default=None,
+            help="Language of the exercise (default the course language)")
+        parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+            help="Number of containers ordered at the same time")
+        parser.add_argument("--host-url", required=True,
+            help="Grader URL that the containers post the results to, e.g. http://grader:8080")
+        parser.add_argument("--collect-address", default="localhost:0",
+            help="Address where the grader posts the results to this command (default a free localhost port)")
+        parser.add_argument("--result-url", default=None,
+            help="URL that receives the results instead of this command, with the submission id in the sid parameter")
+        parser.add_argument("--wait", type=float, default=600,
+            help="Seconds to wait for the results after the containers are ordered")
+
+    def handle(self, *args, **options):
+        if "/" not in options["exercise"]:
+            raise CommandError("Exercise must be given as <course_key>/<exercise_key>")
+        course_key, exercise_key = options["exercise"].split("/", 1)
+        (course, exercise) = config.exercise_entry(course_key, exercise_key, lang=options["lang"])
+        if course is None:
+            raise CommandError("Course not found for key: %s" % (course_key))
+        if exercise is None:
+            raise CommandError("Exercise not found for key: %s/%s" % (course_key, exercise_key))
+        if "container" not in exercise:
+            # The submissions of the other exercises are not stored.
+            raise CommandError("Exercise %s/%s is not graded in a container" % (course_key, exercise_key))
+        if exercise.get("personalized", False):
+            raise CommandError("Personalized exercises can not be regraded, "
+                "because the submitters are not stored with the submissions")
+        if options["jobs"] < 1:
+            raise CommandError("--jobs value must be at least 1")
+
+        submissions = [(sid, str(path)) for sid, path in stored_submissions(course_key, exercise_key)]
+        self.stdout.write("Found %d stored submissions for %s/%s" % (
+            len(submissions), course_key, exercise_key))
+
+        collector = None
+        if options["result_url"]:
+            result_url = lambda sid: update_url_params(options["result_url"], { "sid": sid })
+        else:
+            collector = ResultCollector(options["collect_address"])
+            result_url = collector.url
+        try:
+            with open(options["output"], "w") as output:
+                done = self.regrade(course, exercise, submissions, result_url,
+                    collector, output, options)
+        finally:
+            if collector:
+                collector.close()
+        self.stdout.write("Wrote %d results to %s" % (done, options["output"]))
+
+    def write(self, output, record, done, total):
+        output.write(json.dumps(record) + "\n")
+        output.flush()
+        done += 1
+        self.stdout.write("%d/%d submissions regraded" % (done, total))
+        return done
+
+    def regrade(self, course, exercise, submissions, result_url, collector, output, options):
+        # The runner module is loaded only when containers are ordered.
+        from access.types.stdasync import _orderContainer
+
+        def order(sid, path):
+            try:
+                return_code, out, err = _orderContainer(course, exercise, sid, path,
+                    result_url(sid), options["host_url"], exercise["lang"])
+            except ConfigError as e:
+                return { "sid": sid, "error": str(e) }
+            except Exception as e:
+                # The other submissions are still regraded.
+                return { "sid": sid, "error": "Failed to order the container: %r" % (e) }
+            return { "sid": sid, "dispatched": return_code == 0,
+                "return_code": return_code, "out": out, "err": err }
+
+        done = 0
+        dispatched = []
+        with ThreadPoolExecutor(max_workers=options["jobs"]) as pool:
+            futures = [pool.submit(order, sid, path) for sid, path in submissions]
+            for future in as_completed(futures):
+                record = future.result()
+                if collector and record.get("dispatched"):
+                    dispatched.append(record["sid"])
+                else:
+                    done = self.write(output, record, done, len(submissions))
+
+        if dispatched:
+            self.stdout.write("Waiting for %d results" % (len(dispatched)))
+            for record in collector.wait(dispatched, options["wait"]):
+                done = self.write(output, record, done, len(submissions))
+        return done
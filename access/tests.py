@@ -3,10 +3,17 @@
 This module holds unit tests. It has nothing to do with the grader tests.
 '''
 import time, os
+import copy
+import pickle
+import shutil
+import tempfile
+import threading
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
-from django.test import SimpleTestCase
+from django.test import SimpleTestCase, override_settings
 
-from access.config import ConfigParser
+from access.config import ConfigParser, ConfigError
 from util.shell import invoke_script
 
 
@@ -25,8 +32,28 @@ class ConfigTestCase(SimpleTestCase):
     def setUp(self):
         import access
         settings.COURSES_PATH = os.path.join(os.path.dirname(__file__), 'test_data')
+        # Loading courses links their static files, which must not be left
+        # behind in the static directory of the repository.
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        static_settings = override_settings(STATIC_ROOT=static_root)
+        static_settings.enable()
+        self.addCleanup(static_settings.disable)
         self.config = ConfigParser()
 
+    def make_courses_dir(self):
+        courses_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, courses_dir)
+        for course_key in ("course_a", "course_b"):
+            shutil.copytree(
+                os.path.join(settings.COURSES_PATH, "test_course"),
+                os.path.join(courses_dir, course_key),
+            )
+        os.mkdir(os.path.join(courses_dir, "broken"))
+        with open(os.path.join(courses_dir, "broken", "index.yaml"), "w") as f:
+            f.write("name: [unclosed")
+        return courses_dir
+
     def get_course_key(self):
         courses = self.config.courses()
         self.assertGreater(len(courses), 0, "No courses configured")
@@ -36,6 +63,20 @@ class ConfigTestCase(SimpleTestCase):
         from access.config import get_rst_as_html
         self.assertEqual(get_rst_as_html('A **foobar**.'), '<p>A <strong>foobar</strong>.</p>\n')
 
+    def test_rst_cache(self):
+        from util import dict as dict_util
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        with override_settings(CONFIG_CACHE_PATH=cache_dir), \
+                mock.patch.object(dict_util, 'rst_cache', dict_util.LRUCache(2)), \
+                mock.patch('docutils.core.publish_parts', wraps=dict_util.docutils.core.publish_parts) as publish:
+            html = dict_util.get_rst_as_html('Some *cached* text.')
+            self.assertEqual(dict_util.get_rst_as_html('Some *cached* text.'), html)
+            self.assertEqual((dict_util.rst_cache.hits, dict_util.rst_cache.misses), (1, 1))
+            dict_util.rst_cache.clear()
+            self.assertEqual(dict_util.get_rst_as_html('Some *cached* text.'), html)
+            self.assertEqual(publish.call_count, 1)
+
     def test_parsing(self):
         course_root = {'lang': 'en'}
         data = self.config._process_exercise_data(course_root, self.TEST_DATA)
@@ -73,3 +114,721 @@ class ConfigTestCase(SimpleTestCase):
         self.assertGreater(root["mtime"], mtime)
         self.assertGreater(root["ptime"], ptime)
 
+
+    def test_disk_cache(self):
+        course_key = self.get_course_key()
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                override_settings(CONFIG_CACHE_PATH=cache_dir):
+            config = ConfigParser()
+            course_root = config._course_root(course_key)
+            _, exercise = config.exercise_entry(course_root, "arithmetic")
+
+            # A new parser (i.e. another worker) reuses the processed roots.
+            other = ConfigParser()
+            other_root = other._course_root(course_key)
+            self.assertEqual(other_root["ptime"], course_root["ptime"])
+            self.assertIsNotNone(other_root["exercise_loader"])
+            _, other_exercise = other.exercise_entry(other_root, "arithmetic")
+            self.assertEqual(other_exercise, exercise)
+            self.assertEqual(
+                other_root["exercises"]["arithmetic"]["ptime"],
+                course_root["exercises"]["arithmetic"]["ptime"],
+            )
+
+            # Modified files are parsed again.
+            time.sleep(0.01)
+            os.utime(course_root["file"])
+            other = ConfigParser()
+            self.assertGreater(other._course_root(course_key)["ptime"], course_root["ptime"])
+
+            # So are files replaced by older ones.
+            exercise_file = course_root["exercises"]["arithmetic"]["file"]
+            mtime = os.path.getmtime(exercise_file)
+            self.addCleanup(os.utime, exercise_file, (mtime, mtime))
+            os.utime(exercise_file, (mtime - 60, mtime - 60))
+            other = ConfigParser()
+            other_root = other._course_root(course_key)
+            other.exercise_entry(other_root, "arithmetic")
+            self.assertGreater(
+                other_root["exercises"]["arithmetic"]["ptime"],
+                course_root["exercises"]["arithmetic"]["ptime"],
+            )
+
+    def test_file_watcher(self):
+        course_key = self.get_course_key()
+        for mode in ("poll", "auto"):
+            with override_settings(CONFIG_WATCH=mode, CONFIG_WATCH_POLL_INTERVAL=0.01):
+                config = ConfigParser()
+                root = config._course_root(course_key)
+                config.exercise_entry(root, "arithmetic")
+                exercise_root = root["exercises"]["arithmetic"]
+                self.assertIs(config._course_root(course_key), root)
+
+                time.sleep(0.05)
+                os.utime(exercise_root["file"])
+                for _ in range(100):
+                    if config._watcher().is_dirty(config._exercise_token(root, "arithmetic")):
+                        break
+                    time.sleep(0.01)
+                self.assertIs(config._course_root(course_key), root)
+                config.exercise_entry(root, "arithmetic")
+                self.assertGreater(root["exercises"]["arithmetic"]["ptime"], exercise_root["ptime"])
+                config._watcher().close()
+
+    def test_file_watcher_registration(self):
+        from util.fswatch import create_watcher
+        path = os.path.join(tempfile.mkdtemp(), "config.yaml")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        for mode in ("poll", "auto"):
+            watcher = create_watcher(mode, 0.01)
+            since = time.time_ns()
+            # The file is modified while the entry is loaded.
+            with open(path, "w") as f:
+                f.write(mode)
+            watcher.watch("changed", files=[path], since=since)
+            watcher.watch("unchanged", files=[path], since=time.time_ns())
+            self.assertTrue(watcher.is_dirty("changed"))
+            self.assertFalse(watcher.is_dirty("unchanged"))
+            thread = watcher._thread
+            watcher.close()
+            thread.join(1)
+            self.assertFalse(thread.is_alive())
+            self.assertFalse(watcher.is_dirty("unchanged"))
+
+    def test_revalidate_interval(self):
+        course_key = self.get_course_key()
+        root = self.config._course_root(course_key)
+        time.sleep(0.01)
+        os.utime(root["file"])
+        with override_settings(CONFIG_REVALIDATE_INTERVAL=60):
+            self.assertIs(self.config._course_root(course_key), root)
+        with override_settings(CONFIG_REVALIDATE_INTERVAL=0):
+            self.assertIsNot(self.config._course_root(course_key), root)
+
+    def test_courses_loading(self):
+        with override_settings(COURSES_PATH=self.make_courses_dir(), CONFIG_LOAD_WORKERS=2):
+            with self.assertLogs('main', level='INFO') as logs:
+                keys = sorted(c["key"] for c in ConfigParser().courses())
+            self.assertEqual(keys, ["course_a", "course_b"])
+            self.assertTrue(any("broken" in line for line in logs.output))
+
+    def test_courses_incremental_update(self):
+        courses_dir = self.make_courses_dir()
+        with override_settings(COURSES_PATH=courses_dir):
+            config = ConfigParser()
+            config.courses()
+            root_a = config._course_root("course_a")
+            config.exercise_entry(root_a, "arithmetic")
+
+            shutil.rmtree(os.path.join(courses_dir, "course_b"))
+            shutil.copytree(os.path.join(courses_dir, "course_a"), os.path.join(courses_dir, "course_c"))
+            os.utime(courses_dir, (time.time() + 1, time.time() + 1))
+
+            keys = sorted(c["key"] for c in config.courses())
+            self.assertEqual(keys, ["course_a", "course_c"])
+            self.assertIs(config._courses["course_a"], root_a)
+            self.assertIn("arithmetic", root_a["exercises"])
+
+    def test_exercises_kept_on_course_reload(self):
+        course_key = self.get_course_key()
+        root = self.config._course_root(course_key)
+        self.config.exercise_entry(root, "arithmetic")
+        exercise_root = root["exercises"]["arithmetic"]
+
+        time.sleep(0.01)
+        os.utime(root["file"])
+        new_root = self.config._course_root(course_key)
+        self.assertIsNot(new_root, root)
+        self.assertIs(new_root["exercises"]["arithmetic"], exercise_root)
+        self.config.exercise_entry(new_root, "arithmetic")
+        self.assertIs(new_root["exercises"]["arithmetic"], exercise_root)
+
+    @override_settings(CONFIG_REVALIDATE_INTERVAL=60)
+    def test_include_cache(self):
+        courses_dir = self.make_courses_dir()
+        course_dir = os.path.join(courses_dir, "course_a")
+        base = os.path.join(course_dir, "base.yaml")
+        with open(base, "w") as f:
+            f.write("view_type: access.types.stdsync.createForm\ndescription: First\n")
+        for key in ("ex1", "ex2", "ex3"):
+            with open(os.path.join(course_dir, key + ".yaml"), "w") as f:
+                f.write("title: %s\ninclude:\n  - file: base.yaml\n" % (key))
+
+        with self.settings(COURSES_PATH=courses_dir):
+            root = self.config._course_root("course_a")
+            with mock.patch.object(self.config, "_parse_include", wraps=self.config._parse_include) as parse:
+                ex1 = self.config._exercise_root(root, "ex1")
+                self.config._exercise_root(root, "ex2")
+                self.assertEqual(parse.call_count, 1)
+                self.assertEqual(self.config._include_dependents[base], {("course_a", "ex1"), ("course_a", "ex2")})
+
+                with open(base, "w") as f:
+                    f.write("view_type: access.types.stdsync.createForm\ndescription: Second\n")
+                os.utime(base, (time.time() + 10, time.time() + 10))
+                self.assertIs(self.config._exercise_root(root, "ex1"), ex1)
+                self.config._exercise_root(root, "ex3")
+                ex1 = self.config._exercise_root(root, "ex1")
+                self.assertEqual(ex1["data"]["en"]["description"], "Second")
+                self.assertEqual(parse.call_count, 2)
+
+    def test_single_flight_loading(self):
+        course_key = self.get_course_key()
+        config = ConfigParser()
+        load = config._course_root_from_root_dir
+        started = threading.Event()
+
+        def slow_load(*args):
+            started.set()
+            time.sleep(0.1)
+            return load(*args)
+
+        with mock.patch.object(config, "_course_root_from_root_dir", side_effect=slow_load) as patched:
+            leader = threading.Thread(target=config._course_root, args=(course_key,))
+            leader.start()
+            started.wait()
+            others = [threading.Thread(target=config._course_root, args=(course_key,)) for _ in range(4)]
+            for t in others:
+                t.start()
+            for t in [leader] + others:
+                t.join()
+        self.assertEqual(patched.call_count, 1)
+        self.assertEqual(config.cache_stats()["coalesced_loads"], 4)
+
+    def test_cache_stats_log(self):
+        course_key = self.get_course_key()
+        with mock.patch.object(ConfigParser, "STATS_LOG_INTERVAL", 2), \
+                self.assertLogs("main", "INFO") as logs:
+            self.config.exercise_entry(course_key, "arithmetic")
+            self.config.exercise_entry(course_key, "arithmetic")
+        self.assertEqual(self.config.cache_stats()["exercise_lookups"], 2)
+        stats = [line for line in logs.output if "Configuration cache" in line]
+        self.assertEqual(len(stats), 1)
+        self.assertIn("2 exercise lookups", stats[0])
+        self.assertIn("coalesced loads", stats[0])
+
+    def test_store_course_loads(self):
+        course_key = self.get_course_key()
+        store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store_dir)
+        shutil.copytree(os.path.join(settings.COURSES_PATH, course_key), os.path.join(store_dir, course_key))
+        live_root = self.config._course_root(course_key)
+        store_root = self.config._course_root_from_root_dir(course_key, store_dir)
+        self.assertNotEqual(self.config._exercise_token(live_root, "arithmetic"),
+            self.config._exercise_token(store_root, "arithmetic"))
+        self.config.exercise_entry(store_root, "arithmetic", "_root")
+        self.config.exercise_entry(live_root, "arithmetic")
+        self.assertTrue(live_root["exercises"]["arithmetic"]["file"].startswith(settings.COURSES_PATH))
+        self.assertTrue(store_root["exercises"]["arithmetic"]["file"].startswith(store_dir))
+
+    def test_background_reload(self):
+        courses_dir = self.make_courses_dir()
+        with override_settings(COURSES_PATH=courses_dir, CONFIG_BACKGROUND_RELOAD=True):
+            config = ConfigParser()
+            root = config._course_root("course_a")
+
+            # A broken configuration keeps the last good version.
+            with open(root["file"], "a") as f:
+                f.write("\nname: [unclosed")
+            os.utime(root["file"], (time.time() + 1, time.time() + 1))
+            with self.assertLogs('main', level='ERROR'):
+                self.assertIs(config._course_root("course_a"), root)
+                config._reload_executor.shutdown()
+            self.assertIs(config._course_root("course_a"), root)
+
+            # A fixed configuration replaces the stale one in the background.
+            shutil.copy(os.path.join(courses_dir, "course_b", "index.yaml"), root["file"])
+            os.utime(root["file"], (time.time() + 2, time.time() + 2))
+            del root["retry_time"]
+            config._reload_pid = None
+            self.assertIs(config._course_root("course_a"), root)
+            config._reload_executor.shutdown()
+            self.assertIsNot(config._course_root("course_a"), root)
+
+    def test_lazy_language_versions(self):
+        data = self.config._process_exercise_data({'lang': 'en'}, self.TEST_DATA)
+        self.assertEqual(list(data.keys()), ["en", "fi"])
+        self.assertNotIn("fi", data._versions)
+        data.set_fields(key="test")
+        self.assertEqual(data["fi"]["title"], "Eräs otsikko")
+        self.assertEqual(data["fi"]["key"], "test")
+
+        copy = pickle.loads(pickle.dumps(self.config._process_exercise_data({'lang': 'en'}, self.TEST_DATA)))
+        self.assertEqual(copy["fi"]["nested"]["number"], 2)
+
+    def test_shared_language_versions(self):
+        data = dict(self.TEST_DATA, fields=[{'name': 'a', 'options': [{'value': 1}]}])
+        versions = self.config._process_exercise_data({'lang': 'en'}, data)
+        self.assertIs(versions["en"]["fields"], versions["fi"]["fields"])
+        self.assertIsNot(versions["en"]["nested"], versions["fi"]["nested"])
+        with self.assertRaises(TypeError):
+            versions["en"]["fields"][0]["name"] = "b"
+        fields = copy.deepcopy(versions["fi"]["fields"])
+        fields[0]["options"].append({'value': 2})
+        self.assertEqual(len(versions["en"]["fields"][0]["options"]), 1)
+
+        single = self.config._process_exercise_data({'lang': 'en'}, {'fields': [{'name': 'a'}]})
+        single["en"]["fields"][0]["name"] = "b"
+
+    def test_frozen_language_versions(self):
+        data = dict(self.TEST_DATA, fields=[{'name': 'a'}])
+        versions = self.config._process_exercise_data({'lang': 'en'}, data)
+        versions.set_fields(key='exercise')
+        versions.freeze()
+        fi = versions["fi"]
+        self.assertEqual(fi["title"], "Eräs otsikko")
+        self.assertEqual(fi["nested"]["number"], 2)
+        self.assertEqual(fi["lang"], "fi")
+        self.assertEqual(fi["key"], "exercise")
+        self.assertEqual(versions["en"]["title"], "A Title")
+        self.assertIs(fi["fields"], versions["en"]["fields"])
+        with self.assertRaises(TypeError):
+            fi["title"] = "Toinen"
+
+    def test_form_placeholder(self):
+        from access.types.forms import GradedForm
+        data = {
+            'key': 'placeholders',
+            'fieldgroups': [{
+                'pick_randomly': 1,
+                'fields': [
+                    {'type': 'text', 'title': 'Only', 'correct': 'a',
+                     'extra_info': {'placeholder|i18n': {'en': 'Answer', 'fi': 'Vastaus'}}},
+                ],
+            }],
+        }
+        versions = self.config._process_exercise_data({'lang': 'en'}, data)
+        exercise = dict(versions["fi"], lang="fi")
+        with mock.patch.object(ConfigParser, "exercise_entry") as exercise_entry:
+            form = GradedForm(None, exercise=exercise, course={'key': 'course'})
+        exercise_entry.assert_not_called()
+        self.assertEqual(form.fields["field_0"].widget.attrs["placeholder"], "Vastaus")
+
+    def test_form_blueprint(self):
+        from access.types.forms import GradedForm, form_blueprints
+        exercise = {
+            'key': 'blueprint', 'lang': 'en', 'mtime': 1,
+            'fieldgroups': [{'fields': [
+                {'type': 'radio', 'title': 'Pick', 'options': [
+                    {'label': 'A', 'correct': True}, {'label': 'B'}]},
+            ]}],
+        }
+        form_blueprints.clear()
+        first = GradedForm(None, exercise=exercise, course={'key': 'course'})
+        second = GradedForm(None, exercise=exercise, course={'key': 'course'}, model_answer=True)
+        third = GradedForm(None, exercise=exercise, course={'key': 'course'})
+        self.assertIsNot(first.fields["field_0"], third.fields["field_0"])
+        self.assertIs(first.fields["field_0"].choices, third.fields["field_0"].choices)
+        self.assertEqual(first.fields["field_0"].correct, ["option_0"])
+        self.assertIsNone(third.fields["field_0"].initial)
+        self.assertEqual(second.fields["field_0"].initial, "option_0")
+        self.assertEqual(second.fields["field_0"].widget.attrs["disabled"], "disabled")
+        self.assertNotIn("disabled", third.fields["field_0"].widget.attrs)
+
+        # Each sampled textarea has its own prototype.
+        exercise = {
+            'key': 'textareas', 'lang': 'en', 'mtime': 1,
+            'fieldgroups': [{'pick_randomly': 1, 'fields': [
+                {'type': 'textarea', 'title': 'Question %d' % (n), 'key': 'f%d' % (n), 'rows': 3}
+                for n in range(6)
+            ]}],
+        }
+        form_blueprints.clear()
+        titles = set()
+        for uid in range(1, 8):
+            form = GradedForm(None, exercise=exercise, course={'key': 'course'}, uid=str(uid))
+            sampled = form.group_fields[0][0]
+            field = form.fields[sampled['key']]
+            self.assertEqual(field.label, sampled['title'])
+            self.assertEqual(field.widget.attrs['rows'], 3)
+            titles.add(field.label)
+        self.assertGreater(len(titles), 1)
+
+    @override_settings(CONFIG_IMMUTABLE=True)
+    def test_immutable_exercise(self):
+        from access.types.forms import GradedForm
+        from util.templates import _exercise_context
+        course_key = self.get_course_key()
+        course, exercise = self.config.exercise_entry(course_key, "arithmetic", "en")
+        self.assertEqual(exercise["lang"], "en")
+        with self.assertRaises(TypeError):
+            exercise["lang"] = "en"
+
+        form = GradedForm({}, exercise=exercise, course=course)
+        form.is_valid()
+        form.grade()
+        context = _exercise_context(dict(course, static_url="/static/"),
+            dict(exercise, instructions_file="./instructions.html"), None)
+        self.assertEqual(context["exercise"]["instructions_file"], course_key + "/instructions.html")
+
+    def test_compare_methods(self):
+        from access.config import ConfigError
+        from access.types.compare import compare
+        self.assertTrue(compare("string", " Foo\r", "foo"))
+        self.assertFalse(compare("string-requirecase", "Foo", "foo"))
+        self.assertTrue(compare("string-ignorews-ignorequotes", '"a b"', "ab"))
+        self.assertTrue(compare("string", "a\n B ", "A\nb"))
+        self.assertTrue(compare("string-ignorerepl", "res0: Int = 5", "5"))
+        self.assertTrue(compare("unsortedchars", "cba", "abc"))
+        self.assertTrue(compare("regexp-ignoreparenthesis", "f(x)", "/^fx$/"))
+        self.assertTrue(compare("int", "3", "3"))
+        self.assertFalse(compare("int", "", "3"))
+        self.assertTrue(compare("float", "0.1", "0.1000001", float_abs_tol=0.001))
+        self.assertTrue(compare("array", ["a", "b"], "b"))
+        with self.assertRaises(ConfigError):
+            compare("foo", "a", "a")
+
+        courses_dir = self.make_courses_dir()
+        with open(os.path.join(courses_dir, "course_a", "regex.yaml"), "w") as f:
+            f.write("title: Regex\nview_type: access.types.stdsync.createForm\n"
+                "fieldgroups:\n  - fields:\n      - type: text\n        regex: \"[unclosed\"\n")
+        with self.settings(COURSES_PATH=courses_dir):
+            root = self.config._course_root("course_a")
+            with self.assertRaises(ConfigError):
+                self.config._exercise_root(root, "regex")
+
+        with open(os.path.join(courses_dir, "course_a", "regex_fi.yaml"), "w") as f:
+            f.write("title: Regex\nview_type: access.types.stdsync.createForm\n"
+                "fieldgroups:\n  - fields:\n      - type: text\n"
+                "        regex|i18n:\n          en: \"^a$\"\n          fi: \"[unclosed\"\n")
+        with open(os.path.join(courses_dir, "course_a", "number.yaml"), "w") as f:
+            f.write("title: Number\nview_type: access.types.stdsync.createForm\n"
+                "fieldgroups:\n  - fields:\n      - type: text\n        correct: 3\n")
+        with self.settings(COURSES_PATH=courses_dir):
+            root = self.config._course_root("course_a")
+            with self.assertRaises(ConfigError):
+                self.config._exercise_root(root, "number")
+            # The other languages are checked when they are processed.
+            data = self.config._exercise_root(root, "regex_fi")["data"]
+            self.assertNotIn("fi", data._versions)
+            with self.assertRaises(ConfigError):
+                data["fi"]
+
+    @override_settings(GRADING_REGEX_TIMEOUT=0.5)
+    def test_regex_timeout(self):
+        from access.types.compare import RegexTimeout, RegexWorker, RegexWorkerPool, compare
+        from access.types.stdsync import gradeForms
+        self.assertTrue(compare("regexp", "abc", "^a.c$"))
+        self.assertFalse(compare("regexp", "abd", "^a.c$"))
+        with self.assertRaises(RegexTimeout):
+            compare("regexp", "a" * 40 + "b", "^(a+)+$")
+        self.assertTrue(compare("regexp", "abc", "b"))
+
+        # The answer is not accepted and the field reports the grading error.
+        exercise = {"key": "slow", "lang": "en", "mtime": 1, "max_points": 2, "fieldgroups": [{"fields": [
+            {"type": "text", "key": "slow", "points": 1, "regex": "^(a+)+$"},
+            {"type": "text", "key": "fast", "points": 1, "regex": "^b$"},
+        ]}]}
+        result = gradeForms({"key": "course"}, exercise, [{"answers": {"slow": "a" * 40 + "b", "fast": "b"}}])[0]
+        self.assertEqual(result["points"], 1)
+        self.assertEqual(result["error_fields"], ["slow"])
+        self.assertEqual(result["grading_errors"], ["slow"])
+
+        # Concurrent searches run in their own workers, up to the limit.
+        pool = RegexWorkerPool()
+        def search(i):
+            try:
+                return pool.search("^(a+)+$", "a" * 40 + "b", 0.5)
+            except RegexTimeout:
+                return None
+        with override_settings(GRADING_REGEX_WORKERS=2):
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                results = list(executor.map(search, range(4)))
+            elapsed = time.monotonic() - start
+        self.assertEqual(results, [None] * 4)
+        self.assertEqual(pool._started, 2)
+        self.assertGreater(elapsed, 0.9)
+        self.assertLess(elapsed, 1.9)
+        with mock.patch.object(RegexWorkerPool, "IDLE_SECONDS", 0):
+            pool.search("b", "abc", 0.5)
+        self.assertEqual(pool._started, 1)
+
+        worker = RegexWorker()
+        with self.assertRaises(RegexTimeout):
+            worker.search("^(a+)+$", "a" * 40 + "b", 0.5)
+        self.assertTrue(worker.search("b", "abc", 0.5))
+        worker._process.kill()
+        worker._process.join()
+        self.assertTrue(worker.search("b", "abc", 0.5))
+        with mock.patch.object(RegexWorker, "_search", side_effect=[EOFError, (True, True)]):
+            self.assertTrue(worker.search("b", "abc", 0.5))
+        with mock.patch.object(RegexWorker, "_search", side_effect=EOFError):
+            with self.assertRaises(RegexTimeout):
+                worker.search("b", "abc", 0.5)
+        worker._stop()
+
+    def test_subdiff_hints(self):
+        from access.types.forms import get_subdiff_matching_parts
+        self.assertEqual(get_subdiff_matching_parts("hello world", "hello world"), "hello world")
+        self.assertEqual(get_subdiff_matching_parts("helo wrld", "hello world"), "hel-o w-rld")
+        self.assertEqual(get_subdiff_matching_parts("", "abc"), "---")
+        with override_settings(GRADING_SUBDIFF_MAX_LENGTH=10):
+            # Matches beyond the compared length are not found.
+            self.assertEqual(get_subdiff_matching_parts("x" * 100000 + "ab", "a-b"), "--b")
+            self.assertEqual(get_subdiff_matching_parts("a" + "x" * 100000 + "b", "acb"), "a-b")
+
+    def test_batch_grading(self):
+        from access.types.stdsync import gradeForms
+        course_key = self.get_course_key()
+        course, exercise = self.config.exercise_entry(course_key, "arithmetic", "en")
+        correct = {"field_0": "option_1", "field_1": "option_1",
+            "field_2": ["option_0", "option_2"], "field_3": "15"}
+        results = gradeForms(course, exercise, [
+            {"answers": correct},
+            {"answers": dict(correct, field_3="16"), "uid": "3", "ordinal_number": 2},
+            {"answers": dict(correct, field_2=["option_1"])},
+            {"answers": {}},
+        ])
+        self.assertEqual(results[0]["points"], 9)
+        self.assertEqual(results[1]["points"], 6)
+        self.assertEqual(results[1]["error_fields"], ["field_3"])
+        self.assertEqual(results[2]["points"], 7)
+        self.assertEqual(results[3]["points"], 0)
+
+        from access.types.forms import GradedForm
+        grade = GradedForm.grade
+        def failing_grade(form):
+            if form.data.get("field_3") == "17":
+                raise ConfigError("Broken field")
+            return grade(form)
+        with mock.patch.object(GradedForm, "grade", failing_grade):
+            results = gradeForms(course, exercise, [
+                {"answers": dict(correct, field_3="17")},
+                {"answers": correct},
+            ])
+        self.assertIn("Broken field", results[0]["error"])
+        self.assertEqual(results[1]["points"], 9)
+
+        import json
+        from django.test import RequestFactory
+        from access.views import exercise_batch_grade
+        factory = RequestFactory()
+        for submissions in ([{"answers": correct}, "answers"], [{"answers": ["option_1"]}]):
+            request = factory.post("/", json.dumps({"submissions": submissions}),
+                content_type="application/json")
+            response = exercise_batch_grade.__wrapped__(request, course_key, "arithmetic")
+            self.assertEqual(response.status_code, 400)
+        request = factory.post("/", json.dumps({"submissions": [{"answers": correct}]}),
+            content_type="application/json")
+        response = exercise_batch_grade.__wrapped__(request, course_key, "arithmetic")
+        self.assertEqual(json.loads(response.content)["results"][0]["points"], 9)
+
+    def test_json_grading(self):
+        import json
+        from django.test import RequestFactory
+        from access.types.stdsync import createForm
+        course_key = self.get_course_key()
+        course, exercise = self.config.exercise_entry(course_key, "arithmetic", "en")
+        correct = {"field_0": "option_1", "field_1": "option_1",
+            "field_2": ["option_0", "option_2"], "field_3": "16"}
+        factory = RequestFactory()
+        request = factory.post("/?format=json", correct)
+        response = createForm(request, course, exercise, "/")
+        self.assertEqual(response["Content-Type"], "application/json")
+        result = json.loads(response.content)
+        self.assertEqual(result["points"], 6)
+        self.assertEqual(result["error_fields"], ["field_3"])
+        self.assertEqual(result["fields"]["field_3"]["points"], 0)
+        self.assertEqual(result["fields"]["field_0"]["points"], result["fields"]["field_0"]["max_points"])
+        request = factory.post("/", correct, HTTP_ACCEPT="application/json")
+        self.assertEqual(json.loads(createForm(request, course, exercise, "/").content)["points"], 6)
+        request = factory.post("/", correct, HTTP_ACCEPT="text/html,application/json;q=0.9")
+        self.assertNotEqual(createForm(request, course, exercise, "/")["Content-Type"], "application/json")
+
+    def test_regrade_command(self):
+        import json
+        import requests
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from access import views
+        course_key = self.get_course_key()
+        submission_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, submission_dir)
+        for sid in ("20240101000000", "20240101000001", "20240101000002", "20240101000003"):
+            os.makedirs(os.path.join(submission_dir, course_key, "arithmetic", sid, "user"))
+        output = os.path.join(submission_dir, "results.jsonl")
+        (course, exercise) = self.config.exercise_entry(course_key, "arithmetic", "en")
+        container = dict(exercise, container={"image": "grader", "mount": "exercise", "cmd": "/grade"})
+
+        # The runner module needs docker, so the container order is replaced.
+        def order(course, exercise, sid, path, url, host_url, lang):
+            # The grader posts the result of the first two submissions.
+            if sid.endswith("0"):
+                requests.post(url, data={"points": 3, "max_points": 5, "feedback": "Fine"})
+            elif sid.endswith("1"):
+                return 1, "", "No image"
+            elif sid.endswith("3"):
+                raise RuntimeError("Runner crashed")
+            return 0, "", ""
+
+        with override_settings(SUBMISSION_PATH=submission_dir), \
+                mock.patch.object(views.config, "exercise_entry", return_value=(course, container)), \
+                mock.patch.dict("sys.modules", {"access.types.stdasync": mock.Mock(_orderContainer=order)}):
+            call_command("regrade", course_key + "/arithmetic", output=output, jobs=2,
+                host_url="http://grader", wait=0.5, stdout=open(os.devnull, "w"))
+        with open(output) as f:
+            results = { r["sid"]: r for r in map(json.loads, f) }
+        self.assertEqual(results["20240101000000"]["points"], 3)
+        self.assertEqual(results["20240101000000"]["feedback"], "Fine")
+        self.assertFalse(results["20240101000001"]["dispatched"])
+        self.assertIn("No result", results["20240101000002"]["error"])
+        self.assertIn("Runner crashed", results["20240101000003"]["error"])
+
+        with self.assertRaises(CommandError):
+            call_command("regrade", course_key + "/arithmetic", output=output,
+                host_url="http://grader", stdout=open(os.devnull, "w"))
+
+    def test_form_sample_cache(self):
+        from access.types.forms import GradedForm, form_samples
+        options = [{"value": "option_%d" % (n), "label": str(n), "correct": n < 2} for n in range(6)]
+        exercise = {"key": "sampled", "lang": "en", "mtime": 1, "fieldgroups": [
+            {"pick_randomly": 2, "fields": [
+                {"type": "text", "key": "text_%d" % (n), "title": "Text"} for n in range(4)]},
+            {"fields": [
+                {"type": "checkbox", "key": "structured", "title": "Checkbox", "options": options,
+                    "structured-randomized": [[1, ["option_0", "option_1"]], [2, ["option_2", [1, ["option_3", "option_4"]], "option_5"]]]},
+            ]},
+        ]}
+        def sample(uid, ordinal_number):
+            form = GradedForm(None, exercise=exercise, course={"key": "course"},
+                uid=uid, ordinal_number=ordinal_number)
+            return [(name, [c[0] for c in getattr(field, "choices", [])]) for name, field in form.fields.items()]
+        first = sample("1", "1")
+        hits = form_samples.hits
+        self.assertEqual(sample("1", "1"), first)
+        self.assertEqual(form_samples.hits, hits + 2)
+        fields = dict(first)
+        self.assertEqual(len([name for name in fields if name.startswith("text_")]), 2)
+        self.assertEqual(len(fields["structured"]), 3)
+        self.assertEqual(len([c for c in fields["structured"] if c in ("option_0", "option_1")]), 1)
+        exercise["fieldgroups"][1]["fields"][0]["structured-randomized"][0][1].append("unknown")
+        exercise["mtime"] = 2
+        with self.assertRaises(ConfigError):
+            sample("1", "1")
+
+    def test_page_cache(self):
+        from django.test import RequestFactory
+        from access import views
+        from access.views import exercise
+        from util.http import page_cache
+        course_key = self.get_course_key()
+        factory = RequestFactory()
+        def get(post_url, **headers):
+            request = factory.get("/", {"post_url": post_url}, **headers)
+            # The A+ authentication is not under test.
+            return exercise.__wrapped__(request, course_key, "arithmetic")
+        stats = page_cache.stats()
+        with override_settings(EXERCISE_PAGE_CACHE="default"):
+            get("/aplus/exercise/")
+            get("/aplus/exercise/")
+        self.assertEqual(page_cache.stats(), stats)
+
+        (course, arithmetic) = self.config.exercise_entry(course_key, "arithmetic", "en")
+        with override_settings(EXERCISE_PAGE_CACHE="default"), \
+                mock.patch.object(views.config, "exercise_entry",
+                    return_value=(course, dict(arithmetic, page_cache=True))):
+            first = get("/aplus/exercise/")
+            self.assertEqual(first.status_code, 200)
+            self.assertTrue(first.has_header("Last-Modified"))
+            second = get("/aplus/exercise/")
+            self.assertEqual(second.content, first.content)
+            self.assertEqual(page_cache.stats()["hits"], stats["hits"] + 1)
+            self.assertEqual(page_cache.stats()["stores"], stats["stores"] + 1)
+            self.assertIn(b"/aplus/other/", get("/aplus/other/").content)
+            with override_settings(EXERCISE_PAGE_CACHE=None):
+                get("/aplus/exercise/")
+            self.assertEqual(page_cache.stats()["hits"], stats["hits"] + 1)
+
+    def test_aplus_json_cache(self):
+        import json
+        from django.test import RequestFactory
+        from access.views import aplus_json, aplus_json_cache
+        course_key = self.get_course_key()
+        factory = RequestFactory()
+        aplus_json_cache.clear()
+        with self.assertLogs('main', level='INFO') as logs:
+            first = aplus_json.__wrapped__(factory.get("/"), course_key)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn("Exported course", logs.output[0])
+        self.assertIn("modules", json.loads(first.content))
+        etag = first["ETag"]
+        hits = aplus_json_cache.hits
+        second = aplus_json.__wrapped__(factory.get("/"), course_key)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second["ETag"], etag)
+        self.assertEqual(aplus_json_cache.hits, hits + 1)
+        not_modified = aplus_json.__wrapped__(factory.get("/", HTTP_IF_NONE_MATCH=etag), course_key)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified["ETag"], etag)
+        other_host = aplus_json.__wrapped__(factory.get("/", HTTP_HOST="grader.example.com"), course_key)
+        self.assertNotEqual(other_host["ETag"], etag)
+
+    def test_aplus_json_incremental(self):
+        import json
+        from django.test import RequestFactory
+        from access.views import aplus_json, aplus_json_cache, aplus_json_versions
+        courses_dir = self.make_courses_dir()
+        factory = RequestFactory()
+        def export(**params):
+            return aplus_json.__wrapped__(factory.get("/", params), "course_a")
+        with override_settings(COURSES_PATH=courses_dir, CONFIG_REVALIDATE_INTERVAL=0), \
+                mock.patch("access.views.config", ConfigParser()):
+            version = export()["ETag"].strip('"')
+            unchanged = json.loads(export(since=version).content)
+            self.assertTrue(unchanged["incremental"])
+            self.assertEqual(unchanged["version"], version)
+            self.assertEqual(unchanged["modules"], [])
+            self.assertEqual(unchanged["removed"], [])
+
+            course_dir = os.path.join(courses_dir, "course_a")
+            for name, old, new in (
+                ("arithmetic_mcq.yaml", "title: Arithmetic", "title: Changed arithmetic"),
+                ("index.yaml", "  - key: chapter\n", "  - key: added\n    children: []\n  - key: chapter_old\n"),
+            ):
+                path = os.path.join(course_dir, name)
+                with open(path) as f:
+                    content = f.read()
+                with open(path, "w") as f:
+                    f.write(content.replace(old, new))
+                os.utime(path, (time.time() + 2, time.time() + 2))
+
+            changes = json.loads(export(since=version).content)
+            self.assertNotEqual(changes["version"], version)
+            modules = { m["key"]: m for m in changes["modules"] }
+            self.assertEqual([c["key"] for c in modules["programming"]["children"]], ["arithmetic"])
+            self.assertEqual(modules["programming"]["children"][0]["title"], "Changed arithmetic")
+            self.assertEqual(modules["added"]["children"], [])
+            self.assertEqual(len(modules["chapter_old"]["children"]), 1)
+            self.assertIn(["chapter"], changes["removed"])
+            self.assertIn(["chapter", "chp1", "arithmetic"], changes["removed"])
+            self.assertNotIn("incremental", json.loads(export(since="unknown").content))
+
+            # A new order of children is delivered with all of them.
+            response = export(since=version)
+            version = json.loads(response.content)["version"]
+            self.assertEqual(response["ETag"], '"%s"' % (version))
+            path = os.path.join(course_dir, "index.yaml")
+            with open(path) as f:
+                content = f.read()
+            arithmetic = "      - key: arithmetic\n        config: arithmetic_mcq.yaml\n        type: mcq\n"
+            hello = "      - key: hello_python\n        config: hello_python/config.yaml\n        type: prg\n"
+            with open(path, "w") as f:
+                f.write(content.replace(arithmetic + hello, hello + arithmetic))
+            os.utime(path, (time.time() + 4, time.time() + 4))
+            changes = json.loads(export(since=version).content)
+            self.assertEqual([m["key"] for m in changes["modules"]], ["programming"])
+            self.assertEqual([c["key"] for c in changes["modules"][0]["children"]],
+                ["hello_python", "arithmetic"])
+            self.assertEqual(changes["removed"], [])
+
+        # The versions are shared with the other processes in the disk cache.
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        with override_settings(COURSES_PATH=courses_dir, CONFIG_CACHE_PATH=cache_dir), \
+                mock.patch("access.views.config", ConfigParser()):
+            aplus_json_cache.clear()
+            version = export()["ETag"].strip('"')
+            aplus_json_versions.clear()
+            self.assertTrue(json.loads(export(since=version).content)["incremental"])
+            self.assertNotIn("incremental", json.loads(
+                aplus_json.__wrapped__(factory.get("/", {"since": version}), "course_b").content))
@@ -0,0 +1,369 @@
+'''
+Compiled comparisons of questionnaire answers against configured values.
+
+A compare method string such as "string-ignorews-requirecase" is compiled
+once, together with the configured value, into a function that takes the
+answer and returns whether it matches. Regular expressions are compiled
+at the same time. The compiled comparisons are cached, so grading only
+calls the functions.
+
+If settings.GRADING_REGEX_TIMEOUT is set, regular expression searches run
+in child processes that are killed when a search takes longer, so that
+catastrophic backtracking can not block the grader. A search that times
+out raises RegexTimeout, and the form grades the field as a grading error.
+
+Note: when adding new compare methods or modifiers, remember to update
+_validate_compare_method in a-plus-rst-tools/directives/questionnaire.py
+
+'''
+import functools
+import logging
+import math
+import multiprocessing
+import os
+import re
+import threading
+import time
+
+from django.conf import settings
+
+from ..config import ConfigError
+
+
+LOGGER = logging.getLogger('main')
+
+
+REPL_PROMPT_REGEX = re.compile(r'(^(\w+\s)?\w+:\s[\w\.\[\]]+\s=)')
+
+
+class RegexTimeout(Exception):
+    '''
+    A regular expression search took longer than the configured time limit.
+    '''
+
+
+def _serve_searches(conn):
+    compile_pattern = functools.lru_cache(maxsize=1024)(re.compile)
+    while True:
+        try:
+            pattern, text = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send((True, bool(compile_pattern(pattern).search(text))))
+        except Exception as e:
+            conn.send((False, str(e)))
+
+
+class RegexWorker:
+    '''
+    Runs regular expression searches in a child process. The child is
+    killed and replaced if a search does not finish within the time limit.
+    A worker runs one search at a time.
+    '''
+
+    def __init__(self):
+        self._pid = None
+        self._process = None
+        self._conn = None
+
+    def search(self, pattern, text, timeout):
+        '''
+        Searches a regular expression in a text.
+
+        @type pattern: C{str}
+        @param pattern: a regular expression
+        @type text: C{str}
+        @param text: the text to search
+        @type timeout: C{float}
+        @param timeout: the time limit in seconds
+        @rtype: C{bool}
+        @return: True if the pattern was found
+        '''
+        try:
+            ok, result = self._search(pattern, text, timeout)
+        except (EOFError, OSError):
+            # The child died, e.g. it ran out of memory. Try once more with a new one.
+            LOGGER.warning('Regular expression worker died, restarting it: %s', pattern)
+            self._stop()
+            try:
+                ok, result = self._search(pattern, text, timeout)
+            except (EOFError, OSError):
+                self._stop()
+                raise RegexTimeout("Regular expression search failed: %s" % (pattern))
+        if not ok:
+            raise ConfigError("Invalid regular expression in form: %s" % (pattern), error=result)
+        return result
+
+    def _search(self, pattern, text, timeout):
+        if self._pid != os.getpid() or not self._process.is_alive():
+            self._start()
+        self._conn.send((pattern, text))
+        if not self._conn.poll(timeout):
+            self._stop()
+            LOGGER.warning('Regular expression search timed out after %s s: %s', timeout, pattern)
+            raise RegexTimeout("Regular expression search took longer than %s seconds: %s" % (timeout, pattern))
+        return self._conn.recv()
+
+    def _start(self):
+        if self._pid == os.getpid():
+            self._stop()
+        # The child only runs searches, so forking is safe and does not
+        # depend on the interpreter executable like spawning does.
+        ctx = multiprocessing.get_context('fork')
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_serve_searches, args=(child_conn,),
+            name='RegexWorker', daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._pid = os.getpid()
+
+    def _stop(self):
+        if self._process is None:
+            return
+        if self._pid == os.getpid():
+            self._process.kill()
+            self._process.join()
+        self._conn.close()
+        self._process = None
+        self._pid = None
+
+
+class RegexWorkerPool:
+    '''
+    Hands out idle regular expression workers, so that concurrent gradings
+    search in parallel. New workers are started up to
+    settings.GRADING_REGEX_WORKERS, after which the searches wait for an idle
+    one. Workers that stay idle for IDLE_SECONDS are stopped.
+    '''
+    IDLE_SECONDS = 300
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        # (worker, the time it was released) pairs, the latest last.
+        self._idle = []
+        self._started = 0
+        self._pid = None
+
+    def search(self, pattern, text, timeout):
+        '''
+        Searches a regular expression in a text in an idle worker.
+        See RegexWorker.search.
+        '''
+        worker = self._acquire()
+        try:
+            return worker.search(pattern, text, timeout)
+        finally:
+            self._release(worker)
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # The workers of the parent process do not belong to a fork.
+                self._idle = []
+                self._started = 0
+                self._pid = os.getpid()
+            while not self._idle and self._started >= settings.GRADING_REGEX_WORKERS:
+                # The searches are limited by the timeout, so a worker is released soon.
+                self._lock.wait()
+            if self._idle:
+                return self._idle.pop()[0]
+            self._started += 1
+        return RegexWorker()
+
+    def _release(self, worker):
+        expired = []
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            now = time.monotonic()
+            while self._idle and now - self._idle[0][1] > self.IDLE_SECONDS:
+                expired.append(self._idle.pop(0)[0])
+            self._started -= len(expired)
+            self._idle.append((worker, now))
+            self._lock.notify()
+        for idle in expired:
+            idle._stop()
+
+
+regex_worker = RegexWorkerPool()
+
+
+def compare(method, val, cmp, float_rel_tol=1e-09, float_abs_tol=0.0):
+    '''
+    Compares an answer to a configured value.
+
+    @type method: C{str}
+    @param method: a compare method, e.g. "string-ignorews"
+    @param val: the answer
+    @param cmp: the configured value
+    @rtype: C{bool}
+    @return: True if the answer matches
+    '''
+    return comparison(method, cmp, float_rel_tol, float_abs_tol)(val)
+
+
+def comparison(method, cmp, float_rel_tol=1e-09, float_abs_tol=0.0):
+    '''
+    Gets a compiled comparison from the cache or compiles it.
+
+    @rtype: C{function}
+    @return: a function that takes an answer and returns True if it matches
+    '''
+    try:
+        return _cached_comparison(method, cmp, float_rel_tol, float_abs_tol)
+    except TypeError:
+        # Unhashable configured values are not cached.
+        return compile_comparison(method, cmp, float_rel_tol, float_abs_tol)
+
+
+def compile_comparison(method, cmp, float_rel_tol=1e-09, float_abs_tol=0.0):
+    '''
+    Compiles a compare method and a configured value into a function.
+
+    @type method: C{str}
+    @param method: a compare method, e.g. "string-ignorews"
+    @param cmp: the configured value
+    @rtype: C{function}
+    @return: a function that takes an answer and returns True if it matches
+    '''
+    parts = method.split("-")
+    t = parts[0]
+    mods = parts[1:]
+
+    if t == "array":
+        return lambda val: cmp in val
+    elif t == "int":
+        def compare_int(val):
+            if val is None or val == '':
+                return False
+            return int(val) == int(cmp)
+        return compare_int
+    elif t == "float":
+        def compare_float(val):
+            if val is None or val == '':
+                return False
+            return math.isclose(float(val), float(cmp), rel_tol=float_rel_tol, abs_tol=float_abs_tol)
+        return compare_float
+    elif t not in ("unsortedchars", "string", "regexp"):
+        raise ConfigError("Unknown compare method in form: %s" % (t))
+    if not isinstance(cmp, str):
+        raise ConfigError("Compare method %s requires a string value, not: %r" % (t, cmp))
+
+    # The answer goes through the same steps as the configured value,
+    # which is prepared here once.
+    steps = [lambda v: v.strip().replace("\r", "")]
+    cmp = steps[0](cmp)
+
+    if "ignorerepl" in mods:
+        def strip_repl(v):
+            m = REPL_PROMPT_REGEX.match(v)
+            if m:
+                return v[len(m.group(1)):].strip()
+            return v
+        steps.append(strip_repl)
+
+    if "ignorews" in mods or t == "unsortedchars":
+        def strip_ws(v):
+            return ''.join(v.split())
+        steps.append(strip_ws)
+        cmp = strip_ws(cmp)
+
+    if "ignorequotes" in mods:
+        def strip_quotes(v):
+            if v.startswith("\"") and v.endswith("\""):
+                return v[1:len(v)-1]
+            return v
+        steps.append(strip_quotes)
+        cmp = strip_quotes(cmp)
+
+    if "ignoreparenthesis" in mods:
+        def strip_parenthesis(v):
+            return v.replace("(","").replace(")","")
+        steps.append(strip_parenthesis)
+        if t != "regexp":
+            cmp = strip_parenthesis(cmp)
+
+    def prepare(val):
+        for step in steps:
+            val = step(val)
+        return val
+
+    if t == "unsortedchars":
+        cmp_set = set(cmp)
+        return lambda val: set(prepare(val)) == cmp_set
+    if t == "string":
+        requirecase = "requirecase" in mods
+        if "\n" in cmp:
+            cmp_a = [l.strip() for l in cmp.strip().split("\n")]
+            if not requirecase:
+                cmp_a = [c.lower() for c in cmp_a]
+            def compare_lines(val):
+                val_a = [l.strip() for l in prepare(val).strip().split("\n")]
+                if len(cmp_a) != len(val_a):
+                    return False
+                if requirecase:
+                    return all(c==v for c,v in zip(cmp_a,val_a))
+                return all(c==v.lower() for c,v in zip(cmp_a,val_a))
+            return compare_lines
+        elif requirecase:
+            return lambda val: prepare(val) == cmp
+        cmp_lower = cmp.lower()
+        return lambda val: prepare(val).lower() == cmp_lower
+
+    # regexp
+    if cmp.startswith('/') and cmp.endswith('/'):
+        cmp = cmp[1:-1]
+    try:
+        p = re.compile(cmp)
+    except re.error as e:
+        raise ConfigError("Invalid regular expression in form: %s" % (cmp), error=e) from e
+
+    def search(val):
+        val = prepare(val)
+        timeout = settings.GRADING_REGEX_TIMEOUT
+        if timeout:
+            return regex_worker.search(cmp, val, timeout)
+        return bool(p.search(val))
+    return search
+
+
+_cached_comparison = functools.lru_cache(maxsize=4096)(compile_comparison)
+
+
+def check_comparisons(exercise):
+    '''
+    Checks the compared values of the text fields in a questionnaire and
+    compiles the regular expression comparisons, so that invalid values are
+    reported when the configuration is loaded.
+
+    @type exercise: C{dict}
+    @param exercise: an exercise configuration version
+    '''
+    for group in exercise.get("fieldgroups", []):
+        for field in group.get("fields", []):
+            if field.get("type") not in ("text", "textarea"):
+                continue
+            method = field.get("compare_method", "string")
+            if not isinstance(method, str):
+                raise ConfigError("Invalid compare method in form: %s" % (method))
+            t = method.split("-")[0]
+            mods = method.split("-")[1:]
+            if "regex" in field:
+                _check_string(field, "regex")
+                comparison("regexp", field["regex"])
+            elif "correct" in field and t in ("string", "regexp", "unsortedchars", "subdiff"):
+                _check_string(field, "correct")
+                if t == "regexp":
+                    comparison(method, field["correct"])
+            if t in ("string", "regexp", "subdiff"):
+                for fb in field.get("feedback", []):
+                    if fb.get("compare_regexp", False) and fb.get("value", "") != "%100%":
+                        _check_string(fb, "value")
+                        comparison("-".join(["regexp"] + mods), fb.get("value", ""))
+
+
+def _check_string(configuration, key):
+    if not isinstance(configuration[key], str):
+        raise ConfigError("The \"%s\" of a text field must be a string, not: %r" % (
+            key, configuration[key]))
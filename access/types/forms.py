@@ -1,6 +1,6 @@
-import math
+import copy
+import os
 import random
-import re
 import json
 import difflib
 from collections import OrderedDict
@@ -15,11 +15,48 @@ from django.utils.crypto import get_random_string
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext as _
 
+from util.cache import LRUCache
 from util.templates import template_to_str
 from util import forms as custom_forms
 from .auth import make_hash
+from .compare import RegexTimeout, compare
 from .auth import user_ids_from_string
-from ..config import ConfigError, ConfigParser
+from ..config import ConfigError
+
+
+# Form blueprints by the course key, the exercise key, the language and
+# the modification time of the exercise version.
+form_blueprints = LRUCache(settings.FORM_BLUEPRINT_CACHE_SIZE)
+
+# Random samples by the arguments that determine them.
+form_samples = LRUCache(settings.FORM_SAMPLE_CACHE_SIZE)
+
+
+class FormBlueprint:
+    '''
+    The parts of a form that are the same in every request to an exercise
+    version: the choices of the fields and the prototypes of the form fields.
+    Forms add copies of the prototypes and only apply the random sampling,
+    the bound data and the disabled state themselves.
+    '''
+
+    def __init__(self):
+        self.choices = {}
+        self.fields = {}
+        self.choice_indexes = {}
+
+    @staticmethod
+    def copy_field(prototype):
+        '''
+        Copies a prototype field. The choices and the configured values are
+        shared, the attributes that forms modify are copied.
+        '''
+        field = copy.copy(prototype)
+        field.widget = copy.copy(prototype.widget)
+        field.widget.attrs = prototype.widget.attrs.copy()
+        field.error_messages = prototype.error_messages.copy()
+        field.validators = prototype.validators[:]
+        return field
 
 
 class GradedForm(forms.Form):
@@ -30,6 +67,9 @@ class GradedForm(forms.Form):
     def __init__(self, *args, **kwargs):
         '''
         Constructor. Requires keyword argument "exercise".
+        The random samples are selected by the keyword arguments "uid" and
+        "ordinal_number", which default to the "request" GET parameters.
+        Without them, randomized forms show all questions.
         '''
         if "exercise" not in kwargs:
             raise ConfigError("Missing exercise configuration from form arguments.")
@@ -40,6 +80,12 @@ class GradedForm(forms.Form):
         if not self.exercise.get('reveal_model_at_max_submissions', False):
             self.reveal_correct = False
         self.request = kwargs.pop('request') if 'request' in kwargs else None
+        if self.request is not None:
+            self.uid = kwargs.pop('uid', self.request.GET.get('uid', '1'))
+            self.ordinal_number = kwargs.pop('ordinal_number', self.request.GET.get('ordinal_number', 1))
+        else:
+            self.uid = kwargs.pop('uid', None)
+            self.ordinal_number = kwargs.pop('ordinal_number', 1)
         kwargs['label_suffix'] = ''
 
         # Set form-field ids to be random strings
@@ -58,7 +104,11 @@ class GradedForm(forms.Form):
         self.rng = random.Random()
         self.multipart = False
         self.enrollment_exercise = self.is_enrollment_exercise()
+        self.blueprint = self.get_blueprint()
         self.group_errors = False
+        # The fields of each group included in this form. The exercise
+        # configuration is shared and must not be modified.
+        self.group_fields = []
         samples = []
         g = 0
         i = 0
@@ -96,21 +146,24 @@ class GradedForm(forms.Form):
                     self.disabled = True
                 else:
                     samples.append('-'.join([str(i) for i in indexes]))
-                group["_fields"] = [group["fields"][i] for i in indexes]
+                group_fields = [group["fields"][i] for i in indexes]
             else:
-                group["_fields"] = group["fields"]
+                indexes = range(len(group["fields"]))
+                group_fields = group["fields"]
+            self.group_fields.append(group_fields)
 
             j = 0
-            l = len(group["_fields"]) - 1
+            l = len(group_fields) - 1
 
             # Travel each field in group.
-            for field in group["_fields"]:
+            for field_index, field in zip(indexes, group_fields):
                 if "type" not in field:
                     raise ConfigError("Missing required \"type\" in field configuration for: %s" % (group["name"]))
                 t = field["type"]
+                key = (g, field_index)
 
                 # Create a field by type.
-                choices, initial, correct, neutral = self.create_choices(field)
+                choices, initial, correct, neutral = self.get_choices(field, key)
                 if t == "checkbox":
                     attrs = {'class': 'form-check-input'}
                     if 'randomized' in field and args[0] is not None:
@@ -118,49 +171,49 @@ class GradedForm(forms.Form):
                         self.disabled = True
                     i, f = self.add_field(i, field,
                         forms.MultipleChoiceField, forms.CheckboxSelectMultiple,
-                        initial, correct, neutral, choices, True, attrs, args[0])
+                        initial, correct, neutral, choices, True, attrs, args[0], blueprint_key=key)
                 elif t == "radio":
                     attrs = {'class': 'form-check-input'}
                     i, f = self.add_field(i, field,
                         forms.ChoiceField, forms.RadioSelect,
-                        initial, correct, neutral, choices, False, attrs)
+                        initial, correct, neutral, choices, False, attrs, blueprint_key=key)
                 elif (t == "dropdown" or t == "select"):
                     attrs = {'class': 'form-select'}
                     i, f = self.add_field(i, field,
                         forms.ChoiceField, forms.Select,
-                        initial, correct, neutral, choices, False, attrs)
+                        initial, correct, neutral, choices, False, attrs, blueprint_key=key)
                 elif t == "text":
                     attrs = {'class': 'form-control'}
-                    placeholder = self._get_placeholder(field, g, j)
+                    placeholder = self._get_placeholder(field)
                     if placeholder:
                         attrs['placeholder'] = placeholder
                     i, f = self.add_field(i, field,
                         self._get_text_field_type(field), forms.TextInput,
-                        widget_attrs=attrs)
+                        widget_attrs=attrs, blueprint_key=key)
                 elif t == "textarea":
                     attrs = {'class': 'form-control'}
-                    for key in ['rows', 'cols']:
-                        if key in field:
-                            attrs[key] = field[key]
-                    placeholder = self._get_placeholder(field, g, j)
+                    for attr in ['rows', 'cols']:
+                        if attr in field:
+                            attrs[attr] = field[attr]
+                    placeholder = self._get_placeholder(field)
                     if placeholder:
                         attrs['placeholder'] = placeholder
                     i, f = self.add_field(i, field,
                         self._get_text_field_type(field), forms.Textarea,
-                        widget_attrs=attrs)
+                        widget_attrs=attrs, blueprint_key=key)
                 elif t == "table-radio":
                     i, f = self.add_table_fields(i, field,
-                        forms.ChoiceField, forms.RadioSelect)
+                        forms.ChoiceField, forms.RadioSelect, blueprint_key=key)
                 elif t == "table-checkbox":
                     i, f = self.add_table_fields(i, field,
-                        forms.MultipleChoiceField, forms.CheckboxSelectMultiple, True)
+                        forms.MultipleChoiceField, forms.CheckboxSelectMultiple, True, blueprint_key=key)
                 elif t == "static":
                     i, f = self.add_field(i, field,
-                        forms.CharField, custom_forms.PlainTextWidget)
+                        forms.CharField, custom_forms.PlainTextWidget, blueprint_key=key)
                 elif t == "file":
                     self.multipart = True
                     i, f = self.add_field(i, field,
-                        forms.FileField, forms.ClearableFileInput)
+                        forms.FileField, forms.ClearableFileInput, blueprint_key=key)
                 else:
                     raise ConfigError("Unknown field type: %s" % (t))
 
@@ -209,16 +262,9 @@ class GradedForm(forms.Form):
                 float_tolerances[key] = val
         return float_tolerances
 
-    def _get_placeholder(self, field, group_idx, field_idx):
-        if 'extra_info' in field and 'placeholder' in field['extra_info']:
-            _, exercise_entry = ConfigParser().exercise_entry(
-                self.course['key'],
-                self.exercise['key'],
-                self.exercise.get('lang', None),
-            )
-            translated_extra_info = exercise_entry['fieldgroups'][group_idx]['fields'][field_idx]['extra_info']
-            return translated_extra_info['placeholder']
-        return None
+    def _get_placeholder(self, field):
+        # The exercise is already the version of the form language.
+        return field.get('extra_info', {}).get('placeholder')
 
     def samples_hash(self, sample):
         return make_hash(
@@ -226,10 +272,11 @@ class GradedForm(forms.Form):
             sample
         )
 
-    def add_table_fields(self, i, config, field_class, widget_class, multiple=False):
+    def add_table_fields(self, i, config, field_class, widget_class, multiple=False, blueprint_key=None):
         fields = []
-        choices, initial, correct, neutral = self.create_choices(config)
-        for row in config.get('rows', []):
+        choices, initial, correct, neutral = self.get_choices(config, blueprint_key)
+        for row_index, row in enumerate(config.get('rows', [])):
+            row_key = blueprint_key and blueprint_key + (row_index,)
 
             if self.model_answer:
                 correct = []
@@ -242,7 +289,8 @@ class GradedForm(forms.Form):
             if 'key' in row:
                 row_config['key'] = row['key']
             i, fi = self.add_field(i, row_config,
-                field_class, widget_class, initial, correct, neutral, choices, multiple, {})
+                field_class, widget_class, initial, correct, neutral, choices, multiple, {},
+                blueprint_key=row_key)
             fi[0].row_label = row.get('label', None)
             fields += fi
 
@@ -251,7 +299,8 @@ class GradedForm(forms.Form):
                 more_config = config.copy()
                 more_config['key'] = self.field_name(i, row_config) + '_more'
                 i, fm = self.add_field(i, more_config,
-                    forms.CharField, forms.TextInput)
+                    forms.CharField, forms.TextInput,
+                    blueprint_key=row_key and row_key + ("more",))
                 fm[0].row_label = row.get('label', None)
                 fm[0].table_more = True
                 fields += fm
@@ -262,13 +311,22 @@ class GradedForm(forms.Form):
 
     def add_field(self, i, config, field_class, widget_class,
             initial=None, correct=None, neutral=None, choices=None, multiple=False,
-            widget_attrs={'class': 'form-control'}, post_data=None):
+            widget_attrs={'class': 'form-control'}, post_data=None, blueprint_key=None):
+        # Fields with randomized choices are created for each request,
+        # other fields are copied from the prototypes in the blueprint.
+        prototype_key = None
+        if self.blueprint is not None and blueprint_key is not None and not (
+                choices is not None and multiple
+                and ('randomized' in config or 'structured-randomized' in config)):
+            prototype_key = (blueprint_key, i, self.model_answer)
+            prototype = self.blueprint.fields.get(prototype_key)
+            if prototype is not None:
+                return self._add_field_copy(i, prototype)
+
         args = {
             'widget': widget_class(attrs=widget_attrs),
             'required': 'required' in config and config['required'],
         }
-        if self.disabled:
-            args['widget'].attrs['disabled'] = 'disabled'
 
         name = self.field_name(i, config)
         selected_choices = choices
@@ -288,6 +346,7 @@ class GradedForm(forms.Form):
                         name,
                         choices,
                         post_data,
+                        blueprint_key,
                     )
                 )
             args['choices'] = selected_choices
@@ -340,9 +399,48 @@ class GradedForm(forms.Form):
         else:
             field.html_class = 'form-group'
 
+        if prototype_key is not None:
+            self.blueprint.fields[prototype_key] = field
+            return self._add_field_copy(i, field)
+        if self.disabled:
+            field.widget.attrs['disabled'] = 'disabled'
         self.fields[field.name] = field
         return (i + 1, [field])
 
+    def _add_field_copy(self, i, prototype):
+        field = self.blueprint.copy_field(prototype)
+        if self.disabled:
+            field.widget.attrs['disabled'] = 'disabled'
+        self.fields[field.name] = field
+        return (i + 1, [field])
+
+    def get_blueprint(self):
+        '''
+        Gets the blueprint of the exercise version or None if the version
+        can not be identified.
+        '''
+        try:
+            key = (self.course['key'], self.exercise['key'], self.exercise['lang'], self.exercise['mtime'])
+        except KeyError:
+            return None
+        blueprint = form_blueprints.get(key)
+        if blueprint is None:
+            blueprint = FormBlueprint()
+            form_blueprints.set(key, blueprint)
+        return blueprint
+
+    def get_choices(self, configuration, blueprint_key=None):
+        '''
+        Gets the choices of a field from the blueprint or creates them.
+        The returned lists are shared and must not be modified.
+        '''
+        if self.blueprint is None or blueprint_key is None:
+            return self.create_choices(configuration)
+        choices = self.blueprint.choices.get(blueprint_key)
+        if choices is None:
+            choices = self.blueprint.choices[blueprint_key] = self.create_choices(configuration)
+        return choices
+
     def create_more(self, configuration):
         '''
         Creates more instructions by configuration.
@@ -422,9 +520,29 @@ class GradedForm(forms.Form):
         after each submission attempt or whether it remains the same.
         '''
         # Model answers show all questions
-        if not self.request:
+        if self.uid is None:
             return range(index_range)
 
+        # The sample only depends on the arguments, so it is computed once
+        # for each user and attempt and reused when the form is reloaded.
+        key = (self.exercise['key'], question_key, self.uid,
+            int(self.ordinal_number) if resample_after_attempt else None,
+            is_checkbox_question, how_many, index_range, correct_count,
+            _as_tuple(correct_indexes), _as_tuple(incorrect_indexes), _as_tuple(groups))
+        sample = form_samples.get(key)
+        if sample is None:
+            sample = tuple(self.create_sample(is_checkbox_question, how_many,
+                index_range, correct_count, correct_indexes, incorrect_indexes,
+                question_key, resample_after_attempt, groups))
+            form_samples.set(key, sample)
+        return sample
+
+    def create_sample(self, is_checkbox_question, how_many, index_range,
+                correct_count, correct_indexes, incorrect_indexes,
+                question_key, resample_after_attempt, groups):
+        '''
+        Calculates a random sample deterministically for the user and attempt.
+        '''
         # Set a deterministic random seed based on the user IDs, the ordinal number,
         # and the exercise key so that the random choices change for different
         # users, exercises, and submissions, but they do not change when the user
@@ -434,10 +552,10 @@ class GradedForm(forms.Form):
         # are used for multiple submission attempts.
         # Use a Random instance so that the seed does not affect other uses of
         # the random module elsewhere in the code.
-        self.rng.seed(self.exercise['key'] + question_key + self.request.GET.get('uid', '1'))
+        self.rng.seed(self.exercise['key'] + question_key + self.uid)
         calculated_seed = self.rng.randrange(10000000000)
         if resample_after_attempt:
-            calculated_seed += int(self.request.GET.get('ordinal_number', 1))
+            calculated_seed += int(self.ordinal_number)
         self.rng.seed(calculated_seed)
 
         if is_checkbox_question:
@@ -496,13 +614,14 @@ class GradedForm(forms.Form):
         points = 0
         error_fields = []
         error_groups = []
+        self.grading_errors = []
         g = 0
         i = 0
-        for group in self.exercise["fieldgroups"]:
+        for group, group_fields in zip(self.exercise["fieldgroups"], self.group_fields):
             group_correct = True
             group_points = 0
 
-            for field in group["_fields"]:
+            for field in group_fields:
                 prev = i
                 i, ok, p = self.grade_field(i, field)
                 group_correct = group_correct and ok
@@ -525,82 +644,25 @@ class GradedForm(forms.Form):
         return (points, error_groups, error_fields)
 
     def compare_values(self, method, val, cmp, float_rel_tol=1e-09, float_abs_tol=0.0):
-        # Note: when adding new compare methods or modifiers, remember to update
-        # _validate_compare_method in a-plus-rst-tools/directives/questionnaire.py
-        parts = method.split("-")
-        t = parts[0]
-        mods = parts[1:]
-
-        if t == "array":
-            return cmp in val
-        elif t == "int":
-            if val is None or val == '':
-                return False
-            return int(val) == int(cmp)
-        elif t == "float":
-            if val is None or val == '':
-                return False
-            return math.isclose(float(val), float(cmp), rel_tol=float_rel_tol, abs_tol=float_abs_tol)
-
-        def good_strip(v):
-            return v.strip().replace("\r","")
-        val = good_strip(val)
-        cmp = good_strip(cmp)
-
-        if "ignorerepl" in mods:
-            p = re.compile('(^(\w+\s)?\w+:\s[\w\.\[\]]+\s=)')
-            m = p.match(val)
-            if m:
-                val = val[len(m.group(1)):].strip()
-
-        if "ignorews" in mods or t == "unsortedchars":
-            def strip_ws(v):
-                return ''.join(v.split())
-            val = strip_ws(val)
-            cmp = strip_ws(cmp)
-
-        if "ignorequotes" in mods:
-            def strip_quotes(v):
-                if v.startswith("\"") and v.endswith("\""):
-                    return v[1:len(v)-1]
-                return v
-            val = strip_quotes(val)
-            cmp = strip_quotes(cmp)
-
-        if "ignoreparenthesis" in mods:
-            def strip_parenthesis(v):
-                return v.replace("(","").replace(")","")
-            if t == "regexp":
-                val = strip_parenthesis(val)
-            else:
-                val = strip_parenthesis(val)
-                cmp = strip_parenthesis(cmp)
-
-        if t == "unsortedchars":
-            return set(val) == set(cmp)
-        if t == "string":
-            if "\n" in cmp:
-                cmp_a = [l.strip() for l in cmp.strip().split("\n")]
-                val_a = [l.strip() for l in val.strip().split("\n")]
-                if len(cmp_a) != len(val_a):
-                    return False
-                if "requirecase" in mods:
-                    return all(c==v for c,v in zip(cmp_a,val_a))
-                else:
-                    return all(c.lower()==v.lower() for c,v in zip(cmp_a,val_a))
-            elif "requirecase" in mods:
-                return val == cmp
-            else:
-                return val.lower() == cmp.lower()
-        elif t == "regexp":
-            if cmp.startswith('/') and cmp.endswith('/'):
-                cmp = cmp[1:-1]
-            p = re.compile(cmp)
-            return bool(p.search(val))
-        else:
-            raise ConfigError("Unknown compare method in form: %s" % (t))
+        # The compare method is compiled once and cached in the compare module.
+        return compare(method, val, cmp, float_rel_tol, float_abs_tol)
 
     def grade_field(self, i, configuration):
+        try:
+            return self._grade_field(i, configuration)
+        except RegexTimeout:
+            # The answer could not be checked. It is not accepted and the
+            # field and the result report the grading error.
+            name = self.field_name(i, configuration)
+            self.grading_errors.append(name)
+            if name in self.fields:
+                self.fields[name].grade_points = 0
+                self.fields[name].max_points = configuration.get('points', 0)
+                self.fields[name].hints = [_('HINT_ANSWER_CHECK_TIMED_OUT')]
+                self.fields[name].answer_correct = False
+            return i + 1, False, 0
+
+    def _grade_field(self, i, configuration):
         t = configuration["type"]
 
         if t == "table-radio" or t == "table-checkbox":
@@ -940,45 +1002,46 @@ class GradedForm(forms.Form):
             data["__aplus_post_url"] = post_url
         return json.dumps(data), files
 
-    def get_randomized_checkbox_attributes(self, i, config, initial, correct,
-            name, choices, post_data):
-        self.randomized = True
-        index = 0
+    def get_choice_indexes(self, config, initial, correct, choices, blueprint_key=None):
+        '''
+        Gets the indexes of the correct, incorrect and initial choices and the
+        structured-randomized groups of choice indexes from the blueprint or
+        creates them. The returned values are shared and must not be modified.
+        '''
+        if self.blueprint is None or blueprint_key is None:
+            return self.create_choice_indexes(config, initial, correct, choices)
+        key = (blueprint_key, self.model_answer)
+        indexes = self.blueprint.choice_indexes.get(key)
+        if indexes is None:
+            indexes = self.blueprint.choice_indexes[key] = self.create_choice_indexes(
+                config, initial, correct, choices)
+        return indexes
+
+    def create_choice_indexes(self, config, initial, correct, choices):
         correct_indexes = []
         initial_indexes = []
-        for value, label in choices:
+        for index, (value, label) in enumerate(choices):
             if value in correct:
                 correct_indexes.append(index)
             if value in initial:
                 initial_indexes.append(index)
-            index += 1
         incorrect_indexes = [x for x in range(len(choices)) if x not in correct_indexes]
 
-        if post_data:
-            # grading a submission
-            field_sample = post_data.get(name + '_sample', '')
-            field_checksum = post_data.get(name + '_checksum', '')
-            if self.samples_hash(field_sample) != field_checksum or (
-                not field_sample or not field_checksum
-            ):
-                raise PermissionDenied('Invalid checksum')
-
-        if config.get('randomized'):
-            num_randomized = config.get('randomized')
-            groups = None
-        else:
+        groups = None
+        if not config.get('randomized'):
             # Must be a structured-randomized questionnaire
-            num_randomized = None # Not needed when using groups
-            choice_keys = [choice[0] for choice in choices]
+            choice_keys = { choice[0]: index for index, choice in enumerate(choices) }
 
             def replace_keys_with_indexes_recursive(group):
                 choice_indexes = []
                 for choice_or_subgroup in group[1]:
                     if isinstance(choice_or_subgroup, list):
                         choice_indexes.append(replace_keys_with_indexes_recursive(choice_or_subgroup))
+                    elif choice_or_subgroup in choice_keys:
+                        choice_indexes.append(choice_keys[choice_or_subgroup])
                     else:
-                        choice_indexes.append(choice_keys.index(choice_or_subgroup))
-                return group[0], choice_indexes
+                        raise ConfigError("Unknown option in structured-randomized: %s" % (choice_or_subgroup))
+                return group[0], tuple(choice_indexes)
 
             groups = []
             for group in config.get('structured-randomized'):
@@ -988,6 +1051,25 @@ class GradedForm(forms.Form):
                     raise Exception(
                         "Something went terribly wrong while replacing checkbox answer choice keys with indexes!"
                     ) from e
+        return correct_indexes, incorrect_indexes, initial_indexes, groups
+
+    def get_randomized_checkbox_attributes(self, i, config, initial, correct,
+            name, choices, post_data, blueprint_key=None):
+        self.randomized = True
+        correct_indexes, incorrect_indexes, initial_indexes, groups = self.get_choice_indexes(
+            config, initial, correct, choices, blueprint_key)
+
+        if post_data:
+            # grading a submission
+            field_sample = post_data.get(name + '_sample', '')
+            field_checksum = post_data.get(name + '_checksum', '')
+            if self.samples_hash(field_sample) != field_checksum or (
+                not field_sample or not field_checksum
+            ):
+                raise PermissionDenied('Invalid checksum')
+
+        # Not needed when using groups of a structured-randomized questionnaire
+        num_randomized = config.get('randomized') or None
 
         # The sample is stored in the POST data for only debugging purposes.
         # The random sample used in grading is computed again
@@ -1021,6 +1103,10 @@ class GradedForm(forms.Form):
         return selected_choices, correct_choices, initial_choices, random_attributes
 
 
+def _as_tuple(values):
+    return None if values is None else tuple(values)
+
+
 def get_subdiff_hints(value, all_solutions):
     solutions = all_solutions.split('|')
     if len(solutions) > 1:
@@ -1029,11 +1115,31 @@ def get_subdiff_hints(value, all_solutions):
         matching_parts = []
     for solution in solutions:
         parts = _('HINT_CORRECT_PARTS_IN_YOUR_ANSWER')
-        matches = difflib.SequenceMatcher(None, value, solution).get_matching_blocks()
+        parts += get_subdiff_matching_parts(value, solution)
+        matching_parts.append(parts)
+    return matching_parts
+
+
+def get_subdiff_matching_parts(value, solution):
+    '''
+    Shows the characters of the solution that are found in the answer and
+    a dash in place of the others. The common prefix and suffix match as
+    they are and only the rest is diffed. At most
+    settings.GRADING_SUBDIFF_MAX_LENGTH characters of the rest of the answer
+    are diffed, because the diff time grows with the answer length.
+    '''
+    prefix = len(os.path.commonprefix([value, solution]))
+    suffix = len(os.path.commonprefix([value[prefix:][::-1], solution[prefix:][::-1]]))
+    a = value[prefix:len(value) - suffix][:settings.GRADING_SUBDIFF_MAX_LENGTH]
+    b = solution[prefix:len(solution) - suffix]
+
+    parts = solution[:prefix]
+    if b:
+        matches = difflib.SequenceMatcher(None, a, b).get_matching_blocks()
         i = 0
         for match in matches:
             parts += '-' * (match.b - i)
             i = match.b + match.size
-            parts += value[match.a:match.a + match.size]
-        matching_parts.append(parts)
-    return matching_parts
+            parts += a[match.a:match.a + match.size]
+    parts += solution[len(solution) - suffix:]
+    return parts
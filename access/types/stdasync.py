@@ -322,7 +322,40 @@ def _acceptSubmission(request, course, exercise, post_url, sdir: SubmissionDir):
         surl = f'http://{request.META["HOSTNAME"]}:{request.META["SERVER_PORT"]}{reverse("test-result")}'
         surl_missing = True
 
-    # Order container for grading.
+    return_code, out, err = _orderContainer(course, exercise, sdir.sid, sdir.dir(),
+        surl, request.scheme + "://" + request.get_host(),
+        translation.get_language(), uids, attempt)
+
+    return render_template(request, course, exercise, post_url,
+        "access/async_accepted.html", {
+            "error": return_code != 0,
+            "accepted": True,
+            "missing_url": surl_missing,
+        })
+
+
+def _orderContainer(course, exercise, sid, submission_dir, url, host_url, lang,
+        uids=None, attempt=1):
+    '''
+    Orders a container to grade a stored submission.
+
+    @type sid: C{str}
+    @param sid: a submission id
+    @type submission_dir: C{str}
+    @param submission_dir: the submission directory path
+    @type url: C{str}
+    @param url: the URL that receives the grading result
+    @type host_url: C{str}
+    @param host_url: the grader URL that the container posts the result to
+    @type lang: C{str}
+    @param lang: the language of the feedback
+    @type uids: C{str}
+    @param uids: the submitting users, required by personalized exercises
+    @type attempt: C{int}
+    @param attempt: the ordinal number of the submission
+    @rtype: C{tuple}
+    @return: the return code, stdout and stderr of the runner
+    '''
     c = _requireContainer(exercise)
 
     ro_mounts = c.get("mounts", {}).copy()
@@ -347,33 +380,29 @@ def _acceptSubmission(request, course, exercise, post_url, sdir: SubmissionDir):
         raise ConfigError("Mount paths must be distinct")
 
     if exercise.get("personalized", False):
+        if uids is None:
+            raise ConfigError("The user is required for grading a personalized exercise.")
         personalized_dir = select_generated_exercise_instance(course, exercise, uids, attempt)
         ro_mounts[personalized_dir] = "/personalized_exercise"
 
-    write_submission_meta(sdir.sid, {
-        "url": surl,
-        "dir": str(sdir.dir()),
+    write_submission_meta(sid, {
+        "url": url,
+        "dir": str(submission_dir),
         "course_key": course["key"],
         "exercise_key": exercise["key"],
-        "lang": translation.get_language(),
+        "lang": lang,
     })
     return_code, out, err = runner_func(
         course=course,
         exercise=exercise,
         container_config=c,
-        submission_id=sdir.sid,
-        host_url=request.scheme + "://" + request.get_host(),
-        readwrite_mounts={str(sdir.dir()): "/submission"},
+        submission_id=sid,
+        host_url=host_url,
+        readwrite_mounts={str(submission_dir): "/submission"},
         readonly_mounts=ro_mounts,
         image=c["image"],
         cmd=c["cmd"],
         settings=settings.RUNNER_MODULE_SETTINGS,
     )
     LOGGER.debug(f"Container order exit={return_code} out={out} err={err}")
-
-    return render_template(request, course, exercise, post_url,
-        "access/async_accepted.html", {
-            "error": return_code != 0,
-            "accepted": True,
-            "missing_url": surl_missing,
-        })
+    return return_code, out, err
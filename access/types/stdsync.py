@@ -19,8 +19,9 @@ Functions take arguments:
 
 '''
 from django.core.exceptions import PermissionDenied
+from django.http import JsonResponse
 
-from util.http import not_modified_since, not_modified_response, cache_headers
+from util.http import not_modified_since, not_modified_response, cache_headers, wants_json
 from util.templates import render_configured_template, render_template
 from .forms import GradedForm
 from .auth import make_hash, get_uid
@@ -133,6 +134,9 @@ def createForm(request, course, exercise, post_url):
             pass
         last = max_n > 0 and n >= max_n
 
+    # API clients may ask for the grading result as JSON instead of HTML.
+    json_result = request.method == 'POST' and wants_json(request)
+
     try:
         form = GradedForm(request.POST or None, request.FILES or None,
             exercise=exercise, reveal_correct=last, request=request, course=course)
@@ -140,6 +144,8 @@ def createForm(request, course, exercise, post_url):
         # Randomized forms raise PermissionDenied when the POST data contains
         # forged checksums or samples. It could be cleaner to check those
         # in the form validation, but the old code raises an exception like this.
+        if json_result:
+            return JsonResponse({ "rejected": True, "invalid_checksum": True })
         return render_template(request, course, exercise, post_url,
             'access/exercise_frame.html', { "rejected": True, "invalid_checksum": True })
 
@@ -151,20 +157,19 @@ def createForm(request, course, exercise, post_url):
 
     # Grade valid form posts.
     if form.is_valid():
-        (points, error_groups, error_fields) = form.grade()
-        points = pointsInRange(points, exercise["max_points"])
-
         # Allow passing to asynchronous grading.
         if "container" in exercise:
+            form.grade()
             from .stdasync import _saveForm
             return _saveForm(request, course, exercise, post_url, form)
 
-        # If points are not granted by form fields.
-        if points == 0 and not error_fields:
-            points = exercise["max_points"]
-
-        result = { "form": form, "accepted": True, "points": points,
-            "error_groups": error_groups, "error_fields": error_fields }
+        result = _gradeForm(form, exercise)
+        if json_result:
+            result["fields"] = _fieldResults(form)
+            return JsonResponse(result)
+        result["form"] = form
+    elif json_result:
+        return JsonResponse({ "rejected": True, "errors": form.errors.get_json_data() })
     else:
         # Don't reveal the correct answers if the form was rejected, and a
         # submission was not consumed.
@@ -197,6 +202,80 @@ def createFormModel(request, course, exercise, parameter):
         'access/graded_form_model_solution.html', result)
 
 
+def gradeForms(course, exercise, submissions):
+    '''
+    Grades many submissions to a createForm exercise without rendering,
+    for example to regrade them after the answers were fixed.
+
+    @type course: C{dict}
+    @param course: a course configuration
+    @type exercise: C{dict}
+    @param exercise: an exercise configuration
+    @type submissions: C{list}
+    @param submissions: dicts with the posted "answers" and optionally the
+        "uid" and the "ordinal_number" that select the random samples
+    @rtype: C{list}
+    @return: a result dict for each submission, with an "error" if the
+        configuration failed to grade it
+    '''
+    if "max_points" not in exercise:
+        raise ConfigError("Missing required \"max_points\" in exercise configuration")
+
+    results = []
+    for submission in submissions:
+        kwargs = { "exercise": exercise, "course": course }
+        for key in ("uid", "ordinal_number"):
+            if key in submission:
+                kwargs[key] = str(submission[key])
+        try:
+            form = GradedForm(submission.get("answers", {}), **kwargs)
+            if not form.is_valid():
+                results.append({ "rejected": True, "errors": form.errors.get_json_data() })
+                continue
+            results.append(_gradeForm(form, exercise))
+        except PermissionDenied:
+            results.append({ "rejected": True, "invalid_checksum": True })
+        except ConfigError as e:
+            # The other submissions are still graded.
+            results.append({ "error": str(e) })
+    return results
+
+
+def _gradeForm(form, exercise):
+    '''
+    Grades a valid form.
+    '''
+    (points, error_groups, error_fields) = form.grade()
+    points = pointsInRange(points, exercise["max_points"])
+
+    # If points are not granted by form fields.
+    if points == 0 and not error_fields:
+        points = exercise["max_points"]
+
+    result = { "accepted": True, "points": points,
+        "max_points": exercise["max_points"],
+        "error_groups": error_groups, "error_fields": error_fields }
+    if form.grading_errors:
+        # The fields whose answers could not be checked in time.
+        result["grading_errors"] = form.grading_errors
+    return result
+
+
+def _fieldResults(form):
+    '''
+    Collects the points and the hints of the graded form fields.
+    '''
+    fields = {}
+    for name, field in form.fields.items():
+        if hasattr(field, "grade_points"):
+            fields[name] = {
+                "points": field.grade_points,
+                "max_points": field.max_points,
+                "hints": getattr(field, "hints", []),
+            }
+    return fields
+
+
 def md5Authentication(request, course, exercise, post_url):
     '''
     Creates an md5 hash for user authentication.
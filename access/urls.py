@@ -29,5 +29,10 @@ urlpatterns = [
     path("<slug:course_key>/", views.course, name='course'),
     path("<slug:course_key>/aplus-json", views.aplus_json, name='aplus-json'),
     path("<slug:course_key>/<slug:exercise_key>", views.exercise, name='exercise'),
+    path(
+        "<slug:course_key>/<slug:exercise_key>/batch-grade",
+        views.exercise_batch_grade,
+        name='exercise-batch-grade',
+    ),
     path("login", views.LoginView.as_view(), name="login"),
 ]
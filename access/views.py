@@ -1,33 +1,39 @@
 import copy
 import json
 from json.decoder import JSONDecodeError
+import hashlib
 import logging
 import os
+import time
 from pathlib import Path
 from shutil import rmtree
 from tarfile import TarFile
 from typing import List, Optional
 
 from django.core.exceptions import PermissionDenied
-from django.http import HttpRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpRequest, HttpResponseNotModified
 from django.shortcuts import render
 from django.http.response import HttpResponse, JsonResponse, Http404, HttpResponseForbidden
 from django.utils import timezone
 from django.utils import translation
+from django.utils.http import parse_etags
 from django.utils.translation import gettext as _
 from django.urls import reverse
 from django.conf import settings
 from django.views import View
 
 from access.config import DEFAULT_LANG, EXTERNAL_EXERCISES_DIR, EXTERNAL_FILES_DIR, ConfigError, config
+from access.types.stdsync import gradeForms
 from util import export
+from util.cache import FileCache, LRUCache
 from util.files import (
     read_and_remove_submission_meta,
     renames,
     rm_path,
     write_submission_meta,
 )
-from util.http import post_data
+from util.http import not_modified_since, not_modified_response, page_cache, post_data
 from util.importer import import_named
 from util.auth import (
     access_read_check_if_number,
@@ -46,6 +52,15 @@ from util.templates import template_to_str
 
 LOGGER = logging.getLogger('main')
 
+# The A+ course exports by the course key, the course and exercise
+# modification times and the host they were built for.
+aplus_json_cache = LRUCache(settings.APLUS_JSON_CACHE_SIZE)
+
+# The hashes of the exported modules and exercises by the course key and
+# the export version, for incremental exports. They are also stored in
+# CONFIG_CACHE_PATH if it is set, so that every worker process knows them.
+aplus_json_versions = LRUCache(settings.APLUS_JSON_CACHE_SIZE)
+
 
 @login_required
 def index(request):
@@ -292,8 +307,16 @@ def exercise(request, course_key, exercise_key):
 
     try:
         (course, exercise, lang) = _get_course_exercise_lang(course_key, exercise_key, lang)
+        # Pages that the view marked cacheable are served from the page cache.
+        response = page_cache.get(request, course, exercise, post_url)
+        if response is not None:
+            if not_modified_since(request, exercise):
+                return not_modified_response(request, exercise)
+            return response
         # Try to call the configured view.
-        return import_named(course, exercise['view_type'])(request, course, exercise, post_url)
+        response = import_named(course, exercise['view_type'])(request, course, exercise, post_url)
+        page_cache.set(request, course, exercise, post_url, response)
+        return response
     except (ConfigError, ImportError) as error:
         return render(request, 'access/exercise_config_error.html', {
             'course': course,
@@ -330,6 +353,51 @@ def exercise_ajax(request, course_key, exercise_key):
     return response
 
 
+@login_required
+def exercise_batch_grade(request, course_key, exercise_key):
+    '''
+    Grades many submissions to a questionnaire and returns the results as JSON.
+    The POST body is a JSON object with a "submissions" list, see
+    access.types.stdsync.gradeForms, and optionally the "lang" to grade in.
+    '''
+    if request.method != "POST":
+        return HttpResponse(status=405)
+
+    try:
+        access_write_check_if_number(request, course_key)
+    except PermissionDenied as e:
+        SecurityLog.reject(request, "EXERCISE-BATCH-GRADE", f"course_id={course_key}: {e}")
+        raise
+
+    SecurityLog.accept(request, "EXERCISE-BATCH-GRADE", f"course_id={course_key}")
+
+    try:
+        body = json.loads(request.body)
+        submissions = body["submissions"]
+        if not isinstance(submissions, list):
+            raise ValueError("submissions must be a list")
+        for submission in submissions:
+            if not isinstance(submission, dict):
+                raise ValueError("each submission must be an object")
+            if not isinstance(submission.get("answers", {}), dict):
+                raise ValueError("submission answers must be an object")
+    except (JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        return HttpResponse(f"Invalid batch grading request: {e}", status=400)
+
+    try:
+        (course, exercise, lang) = _get_course_exercise_lang(course_key, exercise_key, body.get("lang"))
+        if exercise.get("view_type") != "access.types.stdsync.createForm" or "container" in exercise:
+            return _error_response(["Batch grading is only supported for synchronous questionnaires."])
+        results = gradeForms(course, exercise, submissions)
+    except ConfigError as e:
+        return _error_response(exc=e)
+
+    return JsonResponse({
+        'success': True,
+        'results': results,
+    })
+
+
 @instance_read_access_required
 def exercise_model(request, course_key, exercise_key, parameter=None):
     '''
@@ -413,9 +481,14 @@ def exercise_template(request, course_key, exercise_key, parameter=None):
 
 
 @instance_read_access_required
-def aplus_json(request: HttpRequest, course_key: str) -> JsonResponse:
+def aplus_json(request: HttpRequest, course_key: str) -> HttpResponse:
     '''
     Delivers the configuration as JSON for A+.
+
+    The ETag of the export is its version. Given a previous version in the
+    "since" parameter, only the modules and their children that changed
+    since are delivered, with the key paths of the removed ones in
+    "removed". The full export is delivered if the version is not known.
     '''
     SecurityLog.accept(request, "APLUS-JSON", f"course_id={course_key}")
 
@@ -426,6 +499,150 @@ def aplus_json(request: HttpRequest, course_key: str) -> JsonResponse:
     if course is None:
         raise Http404()
 
+    cache_key = _aplus_json_cache_key(request, course)
+    cached = cache_key and aplus_json_cache.get(cache_key)
+    if cached:
+        etag, content = cached
+        data = None
+    else:
+        start = time.perf_counter()
+        data = _aplus_json_data(request, course)
+        content = json.dumps(data, cls=DjangoJSONEncoder).encode('utf-8')
+        version = hashlib.sha1(content).hexdigest()
+        etag = '"%s"' % (version)
+        _set_aplus_json_hashes(course_key, version, _aplus_json_hashes(data))
+        LOGGER.info('Exported course "%s" for A+ in %.3f s', course_key, time.perf_counter() - start)
+        # Exports with errors are not cached, the errors are fixed next.
+        if cache_key and "errors" not in data:
+            aplus_json_cache.set(cache_key, (etag, content))
+
+    since = request.GET.get('since')
+    old_hashes = _get_aplus_json_hashes(course_key, since) if since else None
+    if old_hashes is not None:
+        version = etag.strip('"')
+        hashes = _get_aplus_json_hashes(course_key, version)
+        if data is None or hashes is None:
+            data = json.loads(content)
+            hashes = _aplus_json_hashes(data)
+            _set_aplus_json_hashes(course_key, version, hashes)
+        response = JsonResponse(_aplus_json_changes(data, since, version, old_hashes, hashes))
+        response['ETag'] = etag
+        return response
+
+    if etag in parse_etags(request.headers.get('if-none-match', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
+def _aplus_json_cache_key(request, course):
+    '''
+    Identifies the A+ export of a course by the modification times of the
+    course and its exercises and the host that the URLs point to.
+    '''
+    mtime = 0
+    for exercise_key in course.get("exercises", []):
+        try:
+            _, exercise_root = config.exercise_entry(course["key"], exercise_key, '_root')
+        except ConfigError:
+            # The export reports the error.
+            return None
+        if exercise_root is None:
+            return None
+        mtime = max(mtime, exercise_root.default["mtime"])
+    return (course["key"], course["mtime"], mtime, request.scheme, request.get_host())
+
+
+def _aplus_json_hashes(data):
+    '''
+    Hashes the modules and their children in an export by their key paths.
+    Each node has a hash of its fields without the children and a hash of
+    the order of its children. The order of the modules is hashed by the
+    empty path.
+    '''
+    def digest(value):
+        return hashlib.sha1(
+            json.dumps(value, cls=DjangoJSONEncoder, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+    def order(items):
+        return digest([str(item["key"]) for item in items])
+
+    hashes = {}
+    def recursion(items, parent):
+        for item in items:
+            path = parent + (str(item["key"]),)
+            children = item.get("children", [])
+            fields = { k: v for k, v in item.items() if k != "children" }
+            hashes[path] = (digest(fields), order(children))
+            recursion(children, path)
+    modules = data.get("modules", [])
+    hashes[()] = (None, order(modules))
+    recursion(modules, ())
+    return hashes
+
+
+def _aplus_json_disk_cache():
+    if not settings.CONFIG_CACHE_PATH:
+        return None
+    return FileCache(os.path.join(settings.CONFIG_CACHE_PATH, 'aplus-json'))
+
+
+def _get_aplus_json_hashes(course_key, version):
+    '''
+    Gets the hashes of an export version from memory or from the disk cache.
+    '''
+    key = ('aplus-json', course_key, version)
+    hashes = aplus_json_versions.get(key)
+    if hashes is None:
+        disk = _aplus_json_disk_cache()
+        if disk:
+            hashes = disk.get(key)
+            if hashes is not None:
+                aplus_json_versions.set(key, hashes)
+    return hashes
+
+
+def _set_aplus_json_hashes(course_key, version, hashes):
+    key = ('aplus-json', course_key, version)
+    aplus_json_versions.set(key, hashes)
+    disk = _aplus_json_disk_cache()
+    if disk:
+        disk.set(key, hashes)
+
+
+def _aplus_json_changes(data, since, version, old_hashes, hashes):
+    '''
+    Picks the changes between two versions of an export. The modules and
+    children that changed or have changed children are included, with only
+    the changed children. If the order of the children of a node changed,
+    all of them are included in order.
+    '''
+    def prune(items, parent):
+        reordered = old_hashes.get(parent, (None, None))[1] != hashes[parent][1]
+        result = []
+        for item in items:
+            path = parent + (str(item["key"]),)
+            children = prune(item.get("children", []), path)
+            if reordered or children or old_hashes.get(path) != hashes[path]:
+                result.append(dict(item, children=children))
+        return result
+
+    changes = { k: v for k, v in data.items() if k != "modules" }
+    changes["incremental"] = True
+    changes["since"] = since
+    changes["version"] = version
+    changes["modules"] = prune(data.get("modules", []), ())
+    changes["removed"] = [list(path) for path in old_hashes if path and path not in hashes]
+    return changes
+
+
+def _aplus_json_data(request, course):
+    '''
+    Builds the A+ export of a course.
+    '''
     data = _copy_fields(course, [
         "archive_time",
         "assistants",
@@ -481,8 +698,7 @@ def aplus_json(request: HttpRequest, course_key: str) -> JsonResponse:
     data["modules"] = modules
     if errors:
         data["errors"] = errors
-
-    return JsonResponse(data)
+    return data
 
 
 class LoginView(View):
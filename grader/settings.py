@@ -170,6 +170,78 @@ COURSES_PATH = join(BASE_DIR, 'courses')
 # this must be on the same device as COURSES_PATH
 COURSE_STORE = join(BASE_DIR, 'course_store')
 
+# Disk cache of parsed course and exercise configurations:
+# The cache is shared by all worker processes and survives restarts, so that
+# a cold worker does not need to parse every configuration file again.
+# Django process requires write access to this directory. None disables the cache.
+CONFIG_CACHE_PATH = None
+
+# File watching of course configurations:
+# By default, the modification times of the configuration files are checked on
+# every request. Set to "inotify", "poll" or "auto" (inotify if available) to
+# watch the files in a background thread instead. uWSGI requires enable-threads.
+CONFIG_WATCH = None
+# Seconds between the checks of the "poll" mode.
+CONFIG_WATCH_POLL_INTERVAL = 2.0
+
+# Seconds a cached course or exercise configuration is used after its files
+# were last checked, before they are checked again. 0 checks on every request.
+# Ignored if CONFIG_WATCH is set.
+CONFIG_REVALIDATE_INTERVAL = 0
+
+# Serve the previous version of a changed course or exercise configuration
+# while it is reloaded in a background thread. If the reload fails, the
+# previous version is kept and the error is logged.
+CONFIG_BACKGROUND_RELOAD = False
+
+# Number of threads that load the courses when the course list is recreated.
+CONFIG_LOAD_WORKERS = 8
+
+# Freeze the cached exercise configurations, so that any code that tries to
+# modify them fails with TypeError. Meant to be enabled in tests.
+CONFIG_IMMUTABLE = False
+
+# Number of RST to HTML conversions of configuration "|rst" values kept in
+# memory. The conversions are also stored in CONFIG_CACHE_PATH if it is set.
+RST_CACHE_SIZE = 4096
+
+# Seconds a regular expression search of a questionnaire answer may take.
+# If set, the searches run in child processes that are killed on timeout and
+# the field is graded as incorrect with a grading error. None runs searches
+# in process.
+GRADING_REGEX_TIMEOUT = None
+
+# Maximum number of child processes that run regular expression searches
+# in each grader process. Further searches wait for an idle one.
+GRADING_REGEX_WORKERS = 4
+
+# Number of answer characters compared to the solution when the hints of a
+# subdiff question are created. The common beginning and end are not counted.
+GRADING_SUBDIFF_MAX_LENGTH = 2000
+
+# Number of exercise versions whose precompiled questionnaire form fields
+# are kept in memory.
+FORM_BLUEPRINT_CACHE_SIZE = 200
+
+# Number of random samples of randomized questionnaires that are kept in
+# memory, so that reloading a form does not sample the questions again.
+FORM_SAMPLE_CACHE_SIZE = 10000
+
+# Cache of the rendered exercise pages: a cache alias in CACHES, e.g. a
+# LocMemCache, a FileBasedCache or a RedisCache shared by the worker
+# processes. Pages are cached only for the exercises that set page_cache,
+# because every user then gets the same page. None disables the cache.
+EXERCISE_PAGE_CACHE = None
+
+# Seconds a rendered exercise page is kept in the cache. Pages are keyed by
+# the exercise modification time, so they need not expire when edited.
+EXERCISE_PAGE_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Number of course exports for A+ (aplus-json) that are kept in memory.
+# The versions for incremental exports are also stored in CONFIG_CACHE_PATH
+# if it is set, so that they are known by every worker process.
+APLUS_JSON_CACHE_SIZE = 32
+
 # Exercise files submission path:
 # Django process requires write access to this directory.
 SUBMISSION_PATH = join(BASE_DIR, 'uploads')
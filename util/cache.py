@@ -1,4 +1,13 @@
 from collections import OrderedDict
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+
+
+LOGGER = logging.getLogger('main')
 
 
 class InProcessCache(OrderedDict):
@@ -11,3 +20,134 @@ class InProcessCache(OrderedDict):
         super().__setitem__(key, value)
         if len(self) > self.limit:
             self.popitem(last=False)
+
+
+class LRUCache:
+    '''
+    A thread safe in process cache that drops the least recently used
+    entries when it is full. Counts the cache hits and misses.
+    '''
+
+    def __init__(self, limit=1024):
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.limit:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileCache:
+    '''
+    A pickle based cache in a directory that can be shared by processes.
+    Entries are written atomically so that readers never see partial files.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest + '.pickle')
+
+    def get(self, key, default=None):
+        try:
+            with open(self._file(key), 'rb') as f:
+                stored_key, value = pickle.load(f)
+        except FileNotFoundError:
+            return default
+        except Exception:
+            LOGGER.warning('Discarding unreadable cache entry for %r', key, exc_info=True)
+            return default
+        if stored_key != key:
+            return default
+        return value
+
+    def set(self, key, value):
+        path = self._file(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump((key, value), f, pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except (OSError, pickle.PicklingError, TypeError, AttributeError):
+            LOGGER.warning('Failed to write cache entry for %r', key, exc_info=True)
+
+    def delete(self, key):
+        try:
+            os.unlink(self._file(key))
+        except OSError:
+            pass
+
+
+class SingleFlight:
+    '''
+    Runs a function only once at a time for each key. Callers that arrive
+    while the function is running wait for it and share its result.
+    '''
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
@@ -2,9 +2,20 @@
 Utility functions for dictionaries.
 
 '''
+import copy
+import docutils
 import docutils.core
+import hashlib
+import os
 import re
 
+from django.conf import settings
+
+from util.cache import FileCache, LRUCache
+
+
+rst_cache = LRUCache(settings.RST_CACHE_SIZE)
+
 
 def iterate_kvp_with_dfs(node, key_regex=None):
     '''
@@ -41,7 +52,8 @@ def iterate_kvp_with_dfs(node, key_regex=None):
 
 def get_rst_as_html(rst_str):
     '''
-    Return a string with RST formatting as HTML.
+    Return a string with RST formatting as HTML. The results are cached
+    by the content hash in rst_cache and in the configuration disk cache.
 
     @type rst_str: C{str}
     @param rst_str: the RST string to convert
@@ -50,8 +62,93 @@ def get_rst_as_html(rst_str):
     '''
     if not rst_str:
         return rst_str
+    key = hashlib.sha1(rst_str.encode('utf-8')).hexdigest()
+    html = rst_cache.get(key)
+    if html is not None:
+        return html
+    disk = FileCache(os.path.join(settings.CONFIG_CACHE_PATH, 'rst')) \
+        if settings.CONFIG_CACHE_PATH else None
+    disk_key = ('rst', docutils.__version__, key)
+    if disk:
+        html = disk.get(disk_key)
+    if html is None:
+        html = _publish_rst_as_html(rst_str)
+        if disk:
+            disk.set(disk_key, html)
+    rst_cache.set(key, html)
+    return html
+
+
+def _publish_rst_as_html(rst_str):
     try:
         parts = docutils.core.publish_parts(source=rst_str, writer_name='html')
         return parts['fragment']
     except Exception as e:
         return str(e)
+
+
+class FrozenDict(dict):
+    '''
+    A dict that can not be modified. Copies of it are modifiable dicts.
+    '''
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("'%s' object does not support modification" % (type(self).__name__))
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        result = {}
+        memo[id(self)] = result
+        for key, value in self.items():
+            result[copy.deepcopy(key, memo)] = copy.deepcopy(value, memo)
+        return result
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+
+class FrozenList(list):
+    '''
+    A list that can not be modified. Copies of it are modifiable lists.
+    '''
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("'%s' object does not support modification" % (type(self).__name__))
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = clear = extend = insert = pop = remove = reverse = sort = _immutable
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        result = []
+        memo[id(self)] = result
+        result.extend(copy.deepcopy(value, memo) for value in self)
+        return result
+
+    def __reduce__(self):
+        return (type(self), (list(self),))
+
+
+def freeze(node):
+    '''
+    Returns an immutable version of a dictionary (or list) 'node' and its children.
+
+    @type node: C{dict}
+    @param node: the dictionary (or list) to freeze
+    @rtype: C{FrozenDict}
+    @return: the frozen copy or the node itself if it is already frozen
+    '''
+    if isinstance(node, (FrozenDict, FrozenList)):
+        return node
+    if isinstance(node, dict):
+        return FrozenDict((key, freeze(value)) for key, value in node.items())
+    if isinstance(node, list):
+        return FrozenList(freeze(value) for value in node)
+    return node
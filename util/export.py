@@ -181,7 +181,7 @@ def form_fields(languages, exercises):
 
         if 'extra_info' in f:
             es = list_get(fs, 'extra_info', {})
-            extra = es[0]
+            extra = dict(es[0])
             for key in ['validationMessage', 'placeholder']:
                 if key in extra:
                     extra[key] = i18n_map(list_get(es, key, ''))
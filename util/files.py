@@ -103,6 +103,28 @@ def clean_submission_dir(submission_dir):
         shutil.rmtree(submission_dir)
 
 
+def stored_submissions(course_key, exercise_key):
+    '''
+    Lists the stored submission directories of an exercise.
+
+    @type course_key: C{str}
+    @param course_key: a course key
+    @type exercise_key: C{str}
+    @param exercise_key: an exercise key
+    @rtype: C{list}
+    @return: (submission id, directory path) pairs in submission order
+    '''
+    exercise_dir = Path(settings.SUBMISSION_PATH, course_key, exercise_key)
+    if not exercise_dir.is_dir():
+        return []
+    # Submission ids begin with the submission time.
+    return sorted(
+        (path.name, path)
+        for path in exercise_dir.iterdir()
+        if path.is_dir()
+    )
+
+
 def is_safe_file_name(file_name):
     '''
     Checks that a file name is safe for concatenating to some path.
@@ -0,0 +1,327 @@
+'''
+File system watchers that mark cache entries dirty when their files change.
+
+A cache entry is identified by a token. The entry registers the files and
+directories it depends on with watch(). Once any of them changes, the token
+is reported dirty until it is registered again. Checking a token does not
+touch the file system, the changes are detected in a background thread.
+
+'''
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import weakref
+
+
+LOGGER = logging.getLogger('main')
+
+# The watchers of this process, which are reset in a forked child.
+_watchers = weakref.WeakSet()
+
+
+def _after_fork():
+    for watcher in list(_watchers):
+        watcher._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class FileWatcher:
+    '''
+    Watches files by polling their modification times in a background thread.
+    '''
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._token_paths = {}
+        self._path_tokens = {}
+        self._dirty = set()
+        self._running = False
+        self._closed = False
+        self._stopped = threading.Event()
+        self._thread = None
+        self._reset()
+        _watchers.add(self)
+
+    def watch(self, token, files=(), dirs=(), since=None):
+        '''
+        Registers the paths an entry depends on. Replaces the earlier registration.
+        Changes to the files and to the contents of the directories make the token dirty.
+
+        The paths are registered after the entry is loaded. A path that was
+        modified at or after the time "since", given in nanoseconds like
+        time.time_ns() before the load, makes the token dirty at once, so that
+        changes during the load are not lost.
+        '''
+        self._ensure_running()
+        paths = [(os.path.abspath(f), False) for f in files]
+        paths += [(os.path.abspath(d), True) for d in dirs]
+        with self._lock:
+            self._unwatch(token)
+            self._token_paths[token] = paths
+            for key in paths:
+                self._path_tokens.setdefault(key, set()).add(token)
+                self._add_path(*key)
+            if since is not None and any(self._modified_since(path, since) for path, _ in paths):
+                self._dirty.add(token)
+
+    def unwatch(self, token):
+        with self._lock:
+            self._unwatch(token)
+            self._dirty.discard(token)
+
+    def is_dirty(self, token):
+        '''
+        Checks whether any of the token paths has changed. Does not make syscalls.
+        '''
+        if not self._running:
+            self._ensure_running()
+        return token in self._dirty
+
+    def clean(self, token):
+        '''
+        Clears the dirty flag before the entry is reloaded, so that changes
+        during the reload are not lost.
+        '''
+        self._dirty.discard(token)
+
+    def close(self):
+        '''
+        Stops watching. A closed watcher is not started again.
+        '''
+        self._closed = True
+        self._stopped.set()
+        self._running = False
+        _watchers.discard(self)
+
+    def _unwatch(self, token):
+        for key in self._token_paths.pop(token, []):
+            tokens = self._path_tokens.get(key)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._path_tokens[key]
+                    self._remove_path(*key)
+
+    def _mark(self, keys):
+        for key in keys:
+            self._dirty.update(self._path_tokens.get(key, ()))
+
+    def _mark_all(self):
+        self._dirty.update(self._token_paths.keys())
+
+    def _ensure_running(self):
+        if self._running or self._closed:
+            return
+        with self._lock:
+            if self._running or self._closed:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._running = True
+            self._thread.start()
+
+    def _after_fork(self):
+        # Threads do not survive a fork. Entries may have changed before the
+        # child starts its own watcher, so every registered entry is reloaded
+        # and registered again.
+        self._lock = threading.Lock()
+        self._running = False
+        self._mark_all()
+        self._reset()
+
+    def _reset(self):
+        self._mtimes = {}
+
+    def _modified_since(self, path, since):
+        try:
+            return os.stat(path).st_mtime_ns >= since
+        except OSError:
+            return False
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _add_path(self, path, is_dir):
+        if (path, is_dir) not in self._mtimes:
+            self._mtimes[(path, is_dir)] = self._stat(path)
+
+    def _remove_path(self, path, is_dir):
+        self._mtimes.pop((path, is_dir), None)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                items = list(self._mtimes.items())
+            changed = {}
+            for key, old in items:
+                new = self._stat(key[0])
+                if new != old:
+                    changed[key] = new
+            if changed:
+                with self._lock:
+                    for key, new in changed.items():
+                        if key in self._mtimes:
+                            self._mtimes[key] = new
+                    self._mark(changed)
+
+
+class InotifyWatcher(FileWatcher):
+    '''
+    Watches files with Linux inotify. Files are watched through their
+    directories, so that replacing a file by renaming is detected too.
+    '''
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_CLOEXEC = 0o2000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported')
+        self._fd = None
+        self._wake = None
+        super().__init__()
+
+    def close(self):
+        super().close()
+        with self._lock:
+            if self._wake is not None:
+                # Wakes the thread that waits for events.
+                os.write(self._wake[1], b'\0')
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        with self._lock:
+            self._close_fds()
+
+    def _close_fds(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._wake is not None:
+            for fd in self._wake:
+                os.close(fd)
+            self._wake = None
+
+    def _reset(self):
+        self._close_fds()
+        self._fd = self._libc.inotify_init1(self.IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._wake = os.pipe()
+        self._wds = {}
+        self._dirs = {}
+
+    def _add_path(self, path, is_dir):
+        directory = path if is_dir else os.path.dirname(path)
+        if directory in self._wds:
+            return
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            # Missing directories can not be watched. The entry is marked
+            # dirty, so that it is checked again when it is next used.
+            LOGGER.debug('Cannot watch directory "%s": %s', directory,
+                os.strerror(ctypes.get_errno()))
+            self._dirty.update(self._path_tokens.get((path, is_dir), ()))
+            return
+        self._wds[directory] = wd
+        self._dirs[wd] = directory
+
+    def _remove_path(self, path, is_dir):
+        # Directory watches are kept, they are shared by the files in the directory.
+        pass
+
+    def _run(self):
+        fd, wake = self._fd, self._wake[0]
+        while not self._stopped.is_set():
+            try:
+                readable, _, _ = select.select([fd, wake], [], [])
+                if wake in readable or self._stopped.is_set():
+                    return
+                buf = os.read(fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                LOGGER.exception('Reading inotify events failed')
+                with self._lock:
+                    self._mark_all()
+                self._running = False
+                return
+            with self._lock:
+                self._handle_events(buf)
+
+    def _handle_events(self, buf):
+        offset = 0
+        while offset + self.EVENT.size <= len(buf):
+            wd, mask, _cookie, length = self.EVENT.unpack_from(buf, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                self._mark_all()
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                # The directory was removed or replaced.
+                self._mark(key for key in self._path_tokens
+                    if key[0] == directory or key[0].startswith(directory + os.sep))
+                del self._dirs[wd]
+                del self._wds[directory]
+                continue
+            keys = [(directory, True)]
+            if name:
+                keys.append((os.path.join(directory, name), False))
+            self._mark(keys)
+
+
+def create_watcher(mode, interval=2.0):
+    '''
+    Creates a file watcher.
+
+    @type mode: C{str}
+    @param mode: "inotify", "poll" or "auto" (inotify if available, otherwise polling)
+    @type interval: C{float}
+    @param interval: polling interval in seconds
+    @rtype: C{FileWatcher}
+    @return: a file watcher
+    '''
+    if mode in ('inotify', 'auto'):
+        try:
+            return InotifyWatcher()
+        except OSError:
+            if mode == 'inotify':
+                raise
+            LOGGER.info('inotify is not available, polling files for changes instead.')
+    elif mode != 'poll':
+        raise ValueError('Unknown file watcher mode "%s"' % (mode))
+    return FileWatcher(interval)
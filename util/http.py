@@ -2,14 +2,19 @@
 Utility functions for exercise HTTP responses.
 
 '''
+import hashlib
+import json
 import logging
 import requests
+import threading
 import time
 import urllib
 
 from aplus_auth.requests import post as aplus_post
 from django.conf import settings
-from django.http import HttpResponseNotModified
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils import translation
 from django.utils.http import http_date, parse_http_date_safe
 
 from util.templates import template_to_str
@@ -104,6 +109,21 @@ def update_url_params(url, params):
     return url + delimiter + urllib.parse.urlencode(params)
 
 
+def wants_json(request):
+    '''
+    Checks whether the client asks for a JSON response with the "format=json"
+    query parameter or by preferring application/json in the Accept header.
+
+    @type request: C{django.http.request.HttpRequest}
+    @param request: a request
+    @rtype: C{bool}
+    @return: True if the response should be JSON
+    '''
+    if request.GET.get('format') == 'json':
+        return True
+    return request.get_preferred_type(['text/html', 'application/json']) == 'application/json'
+
+
 def cache_headers(response, request, exercise, flag=False):
     if (
         not flag
@@ -131,3 +151,117 @@ def not_modified_since(request, exercise):
 
 def not_modified_response(request, exercise):
     return cache_headers(HttpResponseNotModified(), request, exercise)
+
+
+class PageCache:
+    '''
+    Caches the rendered exercise pages in the Django cache backend named by
+    settings.EXERCISE_PAGE_CACHE, for the exercises that set page_cache.
+    Every user then gets the same page, including its random element ids.
+    Only the responses that the exercise views marked cacheable with
+    cache_headers are stored. The key includes the modification time of the
+    exercise, so a changed exercise is rendered again.
+    '''
+    LOG_INTERVAL = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def _backend(self, request, exercise):
+        if (
+            not settings.EXERCISE_PAGE_CACHE
+            or request.method != 'GET'
+            or exercise.get('personalized', False)
+            or not exercise.get('page_cache', False)
+        ):
+            return None
+        return caches[settings.EXERCISE_PAGE_CACHE]
+
+    def _key(self, course, exercise, post_url):
+        parts = [course['key'], exercise['key'], exercise.get('lang'),
+            translation.get_language(), exercise['mtime'], post_url or '']
+        return 'exercise-page:' + hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def get(self, request, course, exercise, post_url):
+        '''
+        Gets a cached exercise page.
+
+        @type request: C{django.http.request.HttpRequest}
+        @param request: a request to handle
+        @type course: C{dict}
+        @param course: a course configuration
+        @type exercise: C{dict}
+        @param exercise: an exercise configuration
+        @type post_url: C{str}
+        @param post_url: the exercise post URL
+        @rtype: C{django.http.response.HttpResponse}
+        @return: the cached response or None
+        '''
+        backend = self._backend(request, exercise)
+        if backend is None:
+            return None
+        try:
+            page = backend.get(self._key(course, exercise, post_url))
+        except Exception:
+            LOGGER.exception('Failed to read the exercise page cache')
+            page = None
+        with self._lock:
+            if page is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            lookups = self.hits + self.misses
+            if lookups % self.LOG_INTERVAL == 0:
+                LOGGER.info('Exercise page cache: %d hits, %d misses, %.1f %% hit rate',
+                    self.hits, self.misses, 100 * self.hits / lookups)
+        if page is None:
+            return None
+        content, content_type = page
+        return cache_headers(HttpResponse(content, content_type=content_type), request, exercise)
+
+    def set(self, request, course, exercise, post_url, response):
+        '''
+        Stores an exercise page if the view marked it cacheable.
+
+        @type response: C{django.http.response.HttpResponse}
+        @param response: the rendered response
+        '''
+        backend = self._backend(request, exercise)
+        if (
+            backend is None
+            or response.status_code != 200
+            or response.streaming
+            or not response.has_header('Last-Modified')
+        ):
+            return
+        try:
+            backend.set(self._key(course, exercise, post_url),
+                (response.content, response['Content-Type']),
+                settings.EXERCISE_PAGE_CACHE_TIMEOUT)
+        except Exception:
+            LOGGER.exception('Failed to write the exercise page cache')
+            return
+        with self._lock:
+            self.stores += 1
+
+    def stats(self):
+        '''
+        Gets statistics of the page cache in this process.
+
+        @rtype: C{dict}
+        @return: cache metrics by name
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+page_cache = PageCache()
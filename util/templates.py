@@ -87,6 +87,10 @@ def template_to_str(course, exercise, post_url, template, result=None):
 
 
 def _exercise_context(course, exercise, post_url, result=None, request=None):
+    if 'instructions_file' in exercise and exercise['instructions_file'].startswith('./'):
+        # The exercise configuration is shared, the resolved path is set to a copy.
+        exercise = dict(exercise,
+            instructions_file=course['key'] + exercise['instructions_file'][1:])
     ctx = {
         "request": request,
         "course": course,
@@ -96,8 +100,6 @@ def _exercise_context(course, exercise, post_url, result=None, request=None):
         "result": result,
         "unique_id": get_random_string(length=8),
     }
-    if 'instructions_file' in exercise and exercise['instructions_file'].startswith('./'):
-        exercise['instructions_file'] = course['key'] + exercise['instructions_file'][1:]
     if "personalized" in exercise and exercise["personalized"] and request:
         ctx.update(personalized_template_context(course, exercise, request))
     return ctx